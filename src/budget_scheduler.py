@@ -0,0 +1,151 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import time
+from dataclasses import dataclass
+from usage import usage_tracker
+from typing import Dict, List, Optional
+
+
+@dataclass
+class RoundPlan:
+    """What the optimizer spends on one round."""
+    num_prompts_per_round: Dict[str, int]
+    screen_ratio: float  # Fraction of the candidates promoted to full scoring, and of the valid set used to screen them
+    scale: float  # Fraction of a full round the remaining budget affords
+    progress: float  # Fraction of the budget spent before the round
+
+
+class BudgetScheduler:
+    """
+    Plans rounds from wall-clock, eval-token and opt-token budgets instead of a fixed number of rounds.
+
+    The spent fraction of the run is the largest spent fraction of any of the configured budgets. A round may
+    spend at most max_round_fraction of the budget; when the last round of the same kind (feedback/random or
+    format) cost more, the mutators generate proportionally fewer candidates, and the candidates are screened
+    on a slice of the valid set before the best of them are fully scored. The run stops once the budget is
+    spent, or once the best valid score improved by less than min_gain_per_budget per whole budget over the
+    last gain_window rounds.
+    """
+
+    def __init__(
+        self,
+        time_budget: Optional[float] = None,
+        eval_token_budget: Optional[int] = None,
+        opt_token_budget: Optional[int] = None,
+        max_round_fraction: float = 0.25,
+        min_gain_per_budget: float = 0.0,
+        gain_window: int = 2,
+        min_screen_ratio: float = 0.25,
+    ):
+        """
+        Initialize the scheduler.
+
+        Args:
+            time_budget (Optional[float]): Wall-clock seconds of the run.
+            eval_token_budget (Optional[int]): Prompt and completion tokens of the eval and screening LLMs.
+            opt_token_budget (Optional[int]): Prompt and completion tokens of the optimizer LLM.
+            max_round_fraction (float): Largest fraction of the budget a single round may spend. Defaults to 0.25.
+            min_gain_per_budget (float): Stop when the recent valid score gain, extrapolated to the whole budget, is below this. Defaults to 0, never.
+            gain_window (int): Number of recent rounds the gain is measured over. Defaults to 2, one round of each kind.
+            min_screen_ratio (float): Smallest fraction of the candidates, and of the valid set, spent on scoring. Defaults to 0.25.
+        """
+        if time_budget is None and eval_token_budget is None and opt_token_budget is None:
+            raise ValueError("The budget scheduler needs a time, eval token or opt token budget")
+        self.time_budget = time_budget
+        self.eval_token_budget = eval_token_budget
+        self.opt_token_budget = opt_token_budget
+        self.max_round_fraction = max_round_fraction
+        self.min_gain_per_budget = min_gain_per_budget
+        self.gain_window = gain_window
+        self.min_screen_ratio = min_screen_ratio
+
+        self.history: List[Dict] = []
+        self._full_round_costs: Dict[str, float] = {}
+        self._round: Optional[Dict] = None
+        self._elapsed = 0.0
+        self._started: Optional[float] = None
+
+    def start(self) -> None:
+        """Start the clock of the time budget, e.g. when a (resumed) run starts."""
+        self._started = time.time()
+
+    def elapsed(self) -> float:
+        return self._elapsed + (time.time() - self._started if self._started is not None else 0.0)
+
+    def spent(self) -> Dict[str, float]:
+        """Spent fraction of each configured budget."""
+        spent = {}
+        if self.time_budget is not None:
+            spent['time'] = self.elapsed() / self.time_budget
+        if self.eval_token_budget is not None:
+            spent['eval_tokens'] = usage_tracker.totals(role='eval')['total_tokens'] / self.eval_token_budget
+        if self.opt_token_budget is not None:
+            spent['opt_tokens'] = usage_tracker.totals(role='opt')['total_tokens'] / self.opt_token_budget
+        return spent
+
+    def progress(self) -> float:
+        """Spent fraction of the run, that of the most used budget."""
+        return min(1.0, max(self.spent().values()))
+
+    def plan(self, kind: str, num_prompts_per_round: Dict[str, int], screen_ratio: float, best_score: float, allow_screening: bool = True) -> RoundPlan:
+        """
+        Plan the next round.
+
+        Args:
+            kind (str): The kind of round, rounds of the same kind are expected to cost the same.
+            num_prompts_per_round (Dict[str, int]): Candidates per mutator of a full round.
+            screen_ratio (float): Screen ratio of a full round, 1.0 for no screening.
+            best_score (float): Best valid score of the beam before the round.
+            allow_screening (bool): Whether the round may screen candidates. Defaults to True.
+
+        Returns:
+            RoundPlan: The candidates per mutator and the screen ratio of the round.
+        """
+        spent = self.spent()
+        progress = min(1.0, max(spent.values()))
+        allowance = min(1.0 - progress, self.max_round_fraction)
+        full_round_cost = self._full_round_costs.get(kind)
+        scale = min(1.0, allowance / full_round_cost) if full_round_cost else 1.0
+
+        num_prompts = {key: max(1, round(n * scale)) if n > 0 else 0 for key, n in num_prompts_per_round.items()}
+        if scale < 1 and allow_screening:
+            screen_ratio = min(screen_ratio, max(self.min_screen_ratio, scale))
+
+        self._round = {'kind': kind, 'scale': scale, 'spent': spent, 'best_score': best_score}
+        return RoundPlan(num_prompts, screen_ratio, scale, progress)
+
+    def end_round(self, best_score: float) -> None:
+        """Record the cost and the gain of the planned round."""
+        planned, spent = self._round, self.spent()
+        cost = max(spent[budget] - planned['spent'][budget] for budget in spent)
+        gain = best_score - planned['best_score'] if best_score is not None and planned['best_score'] is not None else 0.0
+        self.history.append({'kind': planned['kind'], 'scale': planned['scale'], 'cost': cost, 'gain': gain})
+        if cost > 0:
+            self._full_round_costs[planned['kind']] = cost / planned['scale']
+        self._round = None
+
+    def stop_reason(self) -> Optional[str]:
+        """Why the run should stop before the next round, None to continue."""
+        spent = self.spent()
+        if max(spent.values()) >= 1:
+            return "budget spent (" + ", ".join(f"{budget} {fraction:.1%}" for budget, fraction in spent.items()) + ")"
+
+        recent = self.history[-self.gain_window:]
+        if len(recent) == self.gain_window:
+            cost = sum(entry['cost'] for entry in recent)
+            gain = sum(entry['gain'] for entry in recent)
+            if cost > 0 and gain / cost < self.min_gain_per_budget:
+                return f"valid score gain of {gain:.4f} over the last {len(recent)} rounds is {gain / cost:.4f} per budget, below {self.min_gain_per_budget}"
+        return None
+
+    def state(self) -> Dict:
+        """Time spent and round history, saved with run checkpoints."""
+        return {'elapsed': self.elapsed(), 'history': list(self.history), 'full_round_costs': dict(self._full_round_costs)}
+
+    def load_state(self, state: Dict) -> None:
+        """Continue from the state of a checkpointed run. The budgets themselves are kept."""
+        self._elapsed = state['elapsed']
+        self._started = None
+        self.history = list(state['history'])
+        self._full_round_costs = dict(state['full_round_costs'])
@@ -0,0 +1,70 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Per-round checkpoints of an optimizer run.
+
+Each round writes `checkpoints/round_{round}.pkl` in the run directory, and then points
+`checkpoints/latest` at it. Both are written under a temporary name and renamed, so an interrupted
+run always leaves its last complete checkpoint behind for `--resume`.
+"""
+
+import os
+import pickle
+from typing import Any, Dict, Optional
+
+CHECKPOINT_DIR = 'checkpoints'
+LATEST = 'latest'
+
+
+def atomic_pickle(obj: Any, path: str) -> None:
+    """Pickle obj to path, replacing any previous file only once the new one is completely written."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def save_checkpoint(run_dir: str, round: int, state: Dict[str, Any]) -> str:
+    """
+    Save the state of a run at the end of a round.
+
+    Args:
+        run_dir (str): The output directory of the run.
+        round (int): The round that just ended.
+        state (Dict[str, Any]): The state to save. Objects that must be loaded first (e.g. generated formats) go first.
+
+    Returns:
+        str: The path of the checkpoint.
+    """
+    checkpoint_dir = os.path.join(run_dir, CHECKPOINT_DIR)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = os.path.join(checkpoint_dir, f"round_{round}.pkl")
+    atomic_pickle(state, path)
+
+    tmp_path = os.path.join(checkpoint_dir, f"{LATEST}.tmp")
+    with open(tmp_path, 'w') as f:
+        f.write(str(round))
+    os.replace(tmp_path, os.path.join(checkpoint_dir, LATEST))
+    return path
+
+
+def latest_round(run_dir: str) -> Optional[int]:
+    """The last round checkpointed in a run directory, None if there is no checkpoint."""
+    path = os.path.join(run_dir, CHECKPOINT_DIR, LATEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return int(f.read().strip())
+
+
+def load_checkpoint(run_dir: str, round: Optional[int] = None) -> Dict[str, Any]:
+    """Load the checkpoint of a round, by default the latest one."""
+    if round is None:
+        round = latest_round(run_dir)
+        if round is None:
+            raise FileNotFoundError(f"No checkpoint in {os.path.join(run_dir, CHECKPOINT_DIR)}")
+    with open(os.path.join(run_dir, CHECKPOINT_DIR, f"round_{round}.pkl"), 'rb') as f:
+        return pickle.load(f)
@@ -2,11 +2,19 @@
 # Licensed under the MIT license.
 
 import os
+import json
 import argparse
 import importlib
+import random
 from datetime import datetime
 import logging
+import models
+from models.http_pool import HTTPPoolConfig, close_all
+from models.batch import BatchModel, DirectoryBatchBackend, OpenAIBatchBackend
 from optimizer import Optimizer
+from checkpoint import load_checkpoint
+from usage import usage_tracker
+from budget_scheduler import BudgetScheduler
 from prompt import PromptHistory
 from mutators.case_diagnosis import CaseDiagnosis
 from mutators.monte_carlo_sampling import MonteCarloSampling
@@ -50,15 +58,8 @@ def get_prompt_components(task_name):
     return component_dict
 
 def get_model_class(model_cls_name):
-    if 'Llama' in model_cls_name or 'Mistral' in model_cls_name or 'Phi3' in model_cls_name:
-        model_cls_name = 'Vllm'
-    module_name = f"models.{model_cls_name}"
-    try:
-        module = importlib.import_module(module_name)
-        model_class = getattr(module, f'{model_cls_name}Model')
-        return model_class
-    except (ModuleNotFoundError, AttributeError) as e:
-        raise ImportError(f"Cannot find model named {model_cls_name} in module {module_name}") from e
+    # Backends are looked up in the models registry, which only imports the selected one
+    return models.get_model_class(model_cls_name)
 
 def get_task_class(task_cls_name):
     module_name = f"tasks.{task_cls_name}"
@@ -103,20 +104,73 @@ def get_args():
     parser.add_argument('--num_random', default=1, type=int)
     parser.add_argument('--num_format', default=1, type=int)
     parser.add_argument('--select_method', default='UCT', type=str)
+    parser.add_argument('--expand_workers', default=4, type=int, help='Number of beam members expanded concurrently by the feedback and random mutators')
+    parser.add_argument('--pipeline', action='store_true', help='Score candidates on the eval LLM while the optimizer LLM is still expanding the rest of the beam')
+    parser.add_argument('--seed', default=None, type=int, help='Seed of the optimizer random choices (minibatches, sampled examples, mutated components)')
     parser.add_argument('--gpu_id', default='0', type=str)
+    parser.add_argument('--opt_concurrency', default=8, type=int, help='Maximum number of concurrent requests to the optimizer LLM')
+    parser.add_argument('--opt_rpm', default=None, type=int, help='Requests-per-minute quota of the optimizer LLM deployment')
+    parser.add_argument('--opt_tpm', default=None, type=int, help='Tokens-per-minute quota of the optimizer LLM deployment')
+    parser.add_argument('--opt_max_retries', default=8, type=int, help='Retries of a failed optimizer LLM request before giving up')
+    parser.add_argument('--opt_max_connections', default=64, type=int, help='Size of the HTTP connection pool shared by all optimizer LLM requests')
+    parser.add_argument('--opt_keepalive', default=60.0, type=float, help='Seconds an idle optimizer LLM connection is kept alive for reuse')
+    parser.add_argument('--opt_timeout', default=120.0, type=float, help='Timeout of a single optimizer LLM request, in seconds')
+    parser.add_argument('--opt_cache', default=None, type=str, help='Path to the on-disk completion store of the optimizer LLM, disabled if not set')
+    parser.add_argument('--opt_cache_mode', default='read_through', type=str, choices=['read_through', 'record', 'replay'], help='Serve and store completions, only store them, or only serve them without network access')
+    parser.add_argument('--opt_batch_dir', default=None, type=str, help='Submit optimizer LLM requests as batches, keeping their inputs and results in this directory; interactive if not set')
+    parser.add_argument('--opt_batch_backend', default='openai', type=str, choices=['openai', 'directory'], help='Provider batch endpoint, or a local directory processed in-process through the interactive API')
+    parser.add_argument('--opt_batch_poll', default=30.0, type=float, help='Seconds between two status checks of a submitted batch')
+    parser.add_argument('--opt_token_budget', default=None, type=int, help='Optimizer LLM tokens (prompt + completion) the run may spend before it stops expanding, unlimited if not set')
+    parser.add_argument('--opt_prompt_price', default=0.0, type=float, help='Price of the optimizer LLM in dollars per 1K prompt tokens, for cost reporting')
+    parser.add_argument('--opt_completion_price', default=0.0, type=float, help='Price of the optimizer LLM in dollars per 1K completion tokens, for cost reporting')
+    parser.add_argument('--budget_schedule', action='store_true', help='Replace the fixed number of rounds by the budget scheduler, which sizes every round from the time and token budgets')
+    parser.add_argument('--time_budget', default=None, type=float, help='Wall-clock seconds of a scheduled run, unlimited if not set')
+    parser.add_argument('--eval_token_budget', default=None, type=int, help='Eval LLM tokens (prompt + completion) of a scheduled run, unlimited if not set')
+    parser.add_argument('--max_round_fraction', default=0.25, type=float, help='Largest fraction of the budget a scheduled round may spend before its candidates are cut down')
+    parser.add_argument('--min_gain_per_budget', default=0.0, type=float, help='Stop a scheduled run when its recent valid score gain, per whole budget, falls below this')
+    parser.add_argument('--eval_cache', default=None, type=str, help='Path to the on-disk completion cache of the eval LLM, disabled if not set')
+    parser.add_argument('--async_eval', action='store_true', help='Serve the eval LLM with the vLLM async engine and stream completions')
+    parser.add_argument('--enable_prefix_caching', action='store_true', help='Enable vLLM automatic prefix caching for the eval LLM')
+    parser.add_argument('--score_method', default='full', type=str, choices=['full', 'racing'], help='Evaluate candidates on the whole valid set, or race them on shared slices')
+    parser.add_argument('--race_slice_size', default=10, type=int, help='Number of valid examples added per racing step')
+    parser.add_argument('--race_z', default=1.96, type=float, help='Confidence multiplier used to drop dominated candidates when racing')
+    parser.add_argument('--early_stop', action='store_true', help='Apply the task stopping policy (learned max_tokens, answer truncation) to the eval LLM')
+    parser.add_argument('--screen_llm_pth', default=None, type=str, help='Path of a cheaper eval model used to screen candidates, the eval LLM itself if not set')
+    parser.add_argument('--screen_size', default=-1, type=int, help='Number of valid examples used for screening, -1 for the whole valid set')
+    parser.add_argument('--screen_ratio', default=1.0, type=float, help='Fraction of screened candidates promoted to full scoring, 1.0 disables screening')
+    parser.add_argument('--eval_gpu_memory', default=None, type=float, help='Fraction of GPU memory reserved by the eval LLM, by default 0.9 minus what the screening LLM reserves')
+    parser.add_argument('--screen_gpu_memory', default=0.3, type=float, help='Fraction of GPU memory reserved by the screening LLM')
+    parser.add_argument('--test_eval', default='every_round', type=str, choices=['every_round', 'final'], help='Score the beam on the test set after every round, or only the final beam')
+    parser.add_argument('--resume', default=None, type=str, help='Run directory of an interrupted run to continue from its latest checkpoint, with the arguments it was started with unless given again')
     args = parser.parse_args()
 
+    if args.resume:
+        # The saved arguments become the defaults, so that flags given again (e.g. --rounds) override them
+        with open(os.path.join(args.resume, 'args.json')) as f:
+            saved_args = json.load(f)
+        saved_args.pop('resume', None)
+        parser.set_defaults(**saved_args)
+        args = parser.parse_args()
+
     return args
 
 if __name__ == "__main__":
     args = get_args()
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    if args.seed is not None:
+        random.seed(args.seed)
 
     # Logging Configuration
-    project_name = datetime.now().strftime("%b-%d-%H-%M-%S") + '-' + get_output_marker(args)
-    output_folder = os.path.join('./result/', args.task, f'Opt_{args.opt_llm}-Eval_{args.eval_llm}', project_name)
+    if args.resume:
+        output_folder = os.path.normpath(args.resume)
+        project_name = os.path.basename(output_folder)
+    else:
+        project_name = datetime.now().strftime("%b-%d-%H-%M-%S") + '-' + get_output_marker(args)
+        output_folder = os.path.join('./result/', args.task, f'Opt_{args.opt_llm}-Eval_{args.eval_llm}', project_name)
     os.makedirs(output_folder, exist_ok=True)
+    with open(os.path.join(output_folder, 'args.json'), 'w') as f:
+        json.dump(vars(args), f, indent=2)
     log_file_path = os.path.join(output_folder, 'output_log.txt')
 
     # Define the logger
@@ -129,9 +183,37 @@ if __name__ == "__main__":
     logger.info(f"Initial Prompt: {prompt}")
 
     task = get_task_class(args.task)(data_dir=args.data_dir, train_size=args.train_size, valid_size=args.valid_size, test_size=args.test_size, minibatch_size=args.minibatch_size, answer_marker=" The answer is: ")
+    # A resumed run scores on the split of its checkpoint, before anything (e.g. the stopping policy) is derived from it
+    checkpoint = None
+    if args.resume:
+        checkpoint = load_checkpoint(output_folder)
+        task.set_dataset(checkpoint['dataset'])
     component_dict = get_prompt_components(args.task)
-    opt_llm = get_model_class(args.opt_llm)(max_tokens=4096)
-    eval_llm = get_model_class(args.eval_llm)(model_path=args.vllm_pth, max_tokens=256, stop='\n', repetition_penalty=1.0)
+    opt_llm = get_model_class(args.opt_llm)(max_tokens=4096, max_concurrency=args.opt_concurrency, requests_per_minute=args.opt_rpm, tokens_per_minute=args.opt_tpm, max_retries=args.opt_max_retries, cache_path=args.opt_cache, cache_mode=args.opt_cache_mode, http_pool=HTTPPoolConfig(max_connections=args.opt_max_connections, max_keepalive_connections=args.opt_max_connections, keepalive_expiry=args.opt_keepalive), request_timeout=args.opt_timeout)
+    usage_tracker.set_price(opt_llm.deployment, args.opt_prompt_price, args.opt_completion_price)
+    if args.opt_batch_dir:
+        if args.opt_batch_backend == 'openai':
+            batch_backend = OpenAIBatchBackend(opt_llm.client, url=opt_llm.batch_url)
+        else:
+            batch_backend = DirectoryBatchBackend(os.path.join(args.opt_batch_dir, 'queue'), processor_client=opt_llm.client)
+        opt_llm = BatchModel(opt_llm, batch_backend, args.opt_batch_dir, poll_interval=args.opt_batch_poll, logger=logger)
+    eval_llm_name = 'AsyncVllm' if args.async_eval else args.eval_llm
+    # Both engines share the GPU, so by default the eval LLM leaves room for the screening LLM
+    if args.eval_gpu_memory is None:
+        args.eval_gpu_memory = 0.9 - (args.screen_gpu_memory if args.screen_llm_pth else 0.0)
+    eval_llm = get_model_class(eval_llm_name)(model_path=args.vllm_pth, max_tokens=256, stop='\n', repetition_penalty=1.0, cache_path=args.eval_cache, enable_prefix_caching=args.enable_prefix_caching, gpu_memory_utilization=args.eval_gpu_memory, logger=logger)
+    screen_llm = None
+    if args.screen_llm_pth:
+        screen_llm = get_model_class(eval_llm_name)(model_path=args.screen_llm_pth, max_tokens=256, stop='\n', repetition_penalty=1.0, cache_path=args.eval_cache, enable_prefix_caching=args.enable_prefix_caching, gpu_memory_utilization=args.screen_gpu_memory, logger=logger)
+    if args.early_stop:
+        stopping_policy = task.get_stopping_policy(tokenizer=eval_llm.get_tokenizer())
+        eval_llm.set_stopping_policy(stopping_policy)
+        logger.info(f"Eval LLM stopping policy: stop={stopping_policy.stop}, max_tokens={stopping_policy.max_tokens}")
+        # Screening decodes under the same rules as full scoring, so that the two rank candidates alike
+        if screen_llm:
+            screen_stopping_policy = task.get_stopping_policy(tokenizer=screen_llm.get_tokenizer())
+            screen_llm.set_stopping_policy(screen_stopping_policy)
+            logger.info(f"Screening LLM stopping policy: stop={screen_stopping_policy.stop}, max_tokens={screen_stopping_policy.max_tokens}")
 
     if args.task in ['MultipleChoice']:
         search_pool = SEARCH_POOL['MultiChoice']
@@ -140,8 +222,7 @@ if __name__ == "__main__":
     elif args.task in ['BBH']:
         search_pool = SEARCH_POOL['Classification']
 
-    prompt_history_path = '/mnt/teamdrive/yuanye/PromptHistory/'
-    prompt_history = PromptHistory(init_prompt=prompt, root_path=prompt_history_path, init_round=0)
+    prompt_history = PromptHistory(init_prompt=prompt, root_path=output_folder, init_round=0)
 
     # Mutators
     case_diagnosis = CaseDiagnosis(
@@ -171,6 +252,16 @@ if __name__ == "__main__":
         logger=logger,
     )
 
+    scheduler = None
+    if args.budget_schedule:
+        scheduler = BudgetScheduler(
+            time_budget=args.time_budget,
+            eval_token_budget=args.eval_token_budget,
+            opt_token_budget=args.opt_token_budget,
+            max_round_fraction=args.max_round_fraction,
+            min_gain_per_budget=args.min_gain_per_budget,
+        )
+
     num_prompts_per_round = {"case_diagnosis": args.num_feedbacks, "monte_carlo_sampling": args.num_random, "format": args.num_format}
 
     optimizer = Optimizer(
@@ -188,7 +279,24 @@ if __name__ == "__main__":
         init_temperature=args.init_temperature,
         prompt_history=prompt_history,
         logger=logger,
-        project_name = project_name
+        project_name = project_name,
+        score_method=args.score_method,
+        race_slice_size=args.race_slice_size,
+        race_z=args.race_z,
+        test_eval=args.test_eval,
+        screen_llm=screen_llm,
+        screen_size=args.screen_size,
+        screen_ratio=args.screen_ratio,
+        opt_token_budget=args.opt_token_budget,
+        expand_workers=args.expand_workers,
+        pipeline=args.pipeline,
+        scheduler=scheduler,
     )
 
-    result = optimizer.run(init_prompt=prompt)
\ No newline at end of file
+    if checkpoint:
+        prompt = optimizer.resume(checkpoint)
+
+    try:
+        result = optimizer.run(init_prompt=prompt)
+    finally:
+        close_all()
@@ -0,0 +1,110 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from .Vllm import VllmModel
+from vllm import SamplingParams
+from vllm.engine.arg_utils import AsyncEngineArgs
+from vllm.engine.async_llm_engine import AsyncLLMEngine
+from typing import Iterator, List, Optional, Tuple, Union
+import asyncio
+import threading
+import queue
+import uuid
+
+
+class AsyncVllmModel(VllmModel):
+    """
+    VLLM model served by the vLLM async engine.
+
+    Requests from all callers (valid-set scoring, minibatch evaluation, test-set worker) join the
+    engine's running batch as soon as they are submitted, and completions are yielded as they
+    finish instead of after a whole chunk has been decoded.
+    """
+
+    def _init_engine(self, model_path: Optional[str], enable_prefix_caching: bool, gpu_memory_utilization: float) -> None:
+        # The engine lives on its own event loop, driven by a daemon thread
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name='vllm-async-engine', daemon=True)
+        self._loop_thread.start()
+
+        engine_args = AsyncEngineArgs(model=model_path, enable_prefix_caching=enable_prefix_caching, gpu_memory_utilization=gpu_memory_utilization)
+        self.engine = self._run(self._create_engine(engine_args))
+
+    @staticmethod
+    async def _create_engine(engine_args: AsyncEngineArgs) -> AsyncLLMEngine:
+        return AsyncLLMEngine.from_engine_args(engine_args)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def get_tokenizer(self):
+        tokenizer = self.engine.get_tokenizer()
+        return self._run(tokenizer) if asyncio.iscoroutine(tokenizer) else tokenizer
+
+    async def _generate_one(self, idx: int, prompt: str, sampling_params: SamplingParams, done_queue: queue.Queue) -> None:
+        final_output = None
+        try:
+            async for output in self.engine.generate(prompt, sampling_params, request_id=uuid.uuid4().hex):
+                final_output = output
+            done_queue.put((idx, final_output, None))
+        except Exception as e:
+            done_queue.put((idx, None, e))
+
+    def stream(self, prompts: List[str], desc: str = '', background: bool = False) -> Iterator[Tuple[int, str]]:
+        """
+        Submit prompts to the running engine and yield completions as they finish.
+
+        Args:
+            prompts (List[str]): Input prompts for the model.
+            desc (str): Description of the inference task for logging.
+            background (bool): Accepted for interface compatibility; the async engine schedules all requests together.
+
+        Yields:
+            Tuple[int, str]: The index of a prompt and its completion, in completion order.
+        """
+        if self.logger:
+            self.logger.info(f"VLLM ASYNC | {desc}")
+
+        sampling_params = self._get_sampling_params()
+        keys = [self._cache_key(p, sampling_params) for p in prompts] if self.cache else []
+        cached = self.cache.get_many(keys) if self.cache else {}
+
+        miss_idxs = []
+        for i in range(len(prompts)):
+            if self.cache and keys[i] in cached:
+                yield i, cached[keys[i]]
+            else:
+                miss_idxs.append(i)
+
+        # Submit prompts sharing a prefix next to each other, so that they reuse each other's cached KV blocks
+        done_queue = queue.Queue()
+        for i in sorted(miss_idxs, key=lambda i: prompts[i]):
+            asyncio.run_coroutine_threadsafe(self._generate_one(i, prompts[i], sampling_params, done_queue), self._loop)
+
+        new_entries = {}
+        for _ in miss_idxs:
+            i, output, error = done_queue.get()
+            if error is not None:
+                raise error
+
+            text = output.outputs[0].text
+            if self.stopping_policy:
+                text = self.stopping_policy.truncate(text)
+            self._update_prefix_cache_stats([output])
+
+            if self.cache:
+                new_entries[keys[i]] = text
+                if len(new_entries) >= 64:
+                    self.cache.put_many(new_entries)
+                    new_entries = {}
+            yield i, text
+
+        if self.cache and new_entries:
+            self.cache.put_many(new_entries)
+        self._log_cache_stats(num_generated=len(miss_idxs))
+
+    def _generate(self, prompts: List[str], sampling_params: SamplingParams, batch_size: int, background: bool = False) -> List[str]:
+        outputs = [None] * len(prompts)
+        for i, text in self.stream(prompts, background=background):
+            outputs[i] = text
+        return outputs
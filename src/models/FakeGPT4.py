@@ -0,0 +1,23 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from .GPT4 import GPT4Model
+from .fake_openai import FakeOpenAIClient, PROFILES
+from typing import Optional
+import os
+
+
+class FakeGPT4Model(GPT4Model):
+    """
+    GPT4Model served by the in-process FakeOpenAIClient, for runs without network access.
+
+    The latency/error profile is read from the FAKE_OPENAI_PROFILE environment variable
+    ('instant', 'typical', 'flaky' or 'throttled') unless given explicitly.
+    """
+
+    def __init__(self, max_tokens: int, profile: Optional[str] = None, seed: int = 0, **kwargs):
+        profile = profile or os.environ.get('FAKE_OPENAI_PROFILE', 'instant')
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown fake profile: {profile}, expected one of {list(PROFILES)}")
+        super().__init__(max_tokens, client=FakeOpenAIClient(seed=seed, **PROFILES[profile]), **kwargs)
+        self.deployment = f"fake-{profile}"
@@ -0,0 +1,62 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from .Vllm import VllmModel
+from .base import GenericSamplingParams, truncate_at_stop
+from .fake_openai import stable_hash
+from types import SimpleNamespace
+from typing import Callable, List, Optional
+import os
+import time
+
+
+class FakeLLM:
+    """
+    Stand-in for vllm.LLM: completions are a deterministic function of the prompt, and generation
+    sleeps for a configurable per-batch latency plus per-prompt decode time.
+    """
+
+    def __init__(self, latency: float = 0.0, prompts_per_second: Optional[float] = None, responder: Optional[Callable[[str], str]] = None, seed: int = 0):
+        self.latency = latency
+        self.prompts_per_second = prompts_per_second
+        self.responder = responder or self._default_response
+        self.seed = seed
+
+    def _default_response(self, prompt: str) -> str:
+        # Parsed as a choice letter by MultipleChoice and as a number by GSM8K
+        value = stable_hash(self.seed, prompt)
+        return f"{'ABCD'[value % 4]}. The answer is: {value % 10}."
+
+    def get_tokenizer(self):
+        return None
+
+    def generate(self, prompts: List[str], sampling_params, use_tqdm: bool = False) -> List[SimpleNamespace]:
+        time.sleep(self.latency + (len(prompts) / self.prompts_per_second if self.prompts_per_second else 0))
+
+        outputs = []
+        for prompt in prompts:
+            text = truncate_at_stop(self.responder(prompt), sampling_params.stop)
+            outputs.append(SimpleNamespace(
+                prompt=prompt,
+                prompt_token_ids=[0] * (len(prompt) // 4),
+                num_cached_tokens=0,
+                outputs=[SimpleNamespace(text=text, token_ids=[0] * (len(text) // 4))],
+            ))
+        return outputs
+
+
+class FakeVllmModel(VllmModel):
+    """
+    VllmModel backed by FakeLLM, for runs without a GPU or vllm installed.
+
+    The engine's latency (seconds per batch) and throughput (prompts per second) are read from the
+    FAKE_VLLM_LATENCY and FAKE_VLLM_THROUGHPUT environment variables, and default to instant.
+    """
+    sampling_params_cls = GenericSamplingParams
+
+    def _init_engine(self, model_path: Optional[str], enable_prefix_caching: bool, gpu_memory_utilization: float) -> None:
+        throughput = os.environ.get('FAKE_VLLM_THROUGHPUT')
+        self.llm = FakeLLM(
+            latency=float(os.environ.get('FAKE_VLLM_LATENCY', 0)),
+            prompts_per_second=float(throughput) if throughput else None,
+        )
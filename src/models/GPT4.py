@@ -2,25 +2,92 @@
 # Licensed under the MIT license.
 
 from .base import LLM_Model
-from openai import AzureOpenAI
+from .rate_limiter import RateLimiter, backoff_delay
+from .cache import CompletionCache
+from .http_pool import HTTPPoolConfig, get_api_client, get_http_client
+from usage import usage_tracker, bind_context
+from openai import AzureOpenAI, OpenAI
+from concurrent.futures import ThreadPoolExecutor
 import os
+import json
 import time
-from typing import Optional
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Union
 import logging
 
 
 class GPT4Model(LLM_Model):
-    def __init__(self, max_tokens: int, logger: Optional[logging.Logger] = None):
+    # Client errors that will fail the same way on every retry
+    NON_RETRYABLE_STATUS_CODES = (400, 401, 403, 404, 422)
+    CACHE_MODES = ('read_through', 'record', 'replay')
+    # Endpoint named in batch requests (see models/batch.py)
+    batch_url = '/chat/completions'
+
+    def __init__(
+        self,
+        max_tokens: int,
+        max_concurrency: int = 8,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_retries: int = 8,
+        cache_path: Optional[str] = None,
+        cache_mode: str = 'read_through',
+        http_pool: Optional[HTTPPoolConfig] = None,
+        request_timeout: float = 120.0,
+        client=None,
+        logger: Optional[logging.Logger] = None,
+    ):
         """
         Initialize the GPT-4 model with Azure OpenAI credentials.
 
         Args:
             max_tokens (int): Maximum number of tokens to generate.
+            max_concurrency (int): Maximum number of requests in flight on the shared client. Defaults to 8.
+            requests_per_minute (Optional[int]): Request quota of the deployment. Unlimited if None.
+            tokens_per_minute (Optional[int]): Token quota of the deployment. Unlimited if None.
+            max_retries (int): Number of retries of a failed request before giving up. Defaults to 8.
+            cache_path (Optional[str]): Path to an on-disk store of completions. Disabled if None.
+            cache_mode (str): 'read_through' serves stored completions and stores new ones, 'record' always
+                calls the API and stores the result, 'replay' only serves stored completions and never touches
+                the network. Defaults to 'read_through'.
+            http_pool (Optional[HTTPPoolConfig]): Connection limits of the HTTP client shared by every model calling
+                the same endpoint. Defaults to HTTPPoolConfig().
+            request_timeout (float): Timeout of a single request, in seconds. Defaults to 120.
+            client: An OpenAI-compatible client to use instead of the Azure one, e.g. a FakeOpenAIClient.
             logger (Optional[logging.Logger]): Logger object for logging messages.
         """
         self.max_tokens = max_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
         self.logger = logger
+        self.deployment = "gpt-4"
+        self.seed = 42  # Ensure reproducibility
+        self.http_pool = http_pool or HTTPPoolConfig()
+        self.request_timeout = request_timeout
+
+        if cache_mode not in self.CACHE_MODES:
+            raise ValueError(f"Unknown cache mode: {cache_mode}, expected one of {self.CACHE_MODES}")
+        if cache_mode == 'replay' and not cache_path:
+            raise ValueError("Replay mode requires a cache path")
+        self.cache = CompletionCache(cache_path) if cache_path else None
+        self.cache_mode = cache_mode
+        # Identical requests sampled several times in a run are distinct entries, keyed by their occurrence
+        self._request_counts = Counter()
+        self._request_counts_lock = threading.Lock()
+
+        # Shared by all threads, so the quota holds for the whole process
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+
+        # Bounds the requests in flight across all callers, including nested inference_many calls
+        self._request_slots = threading.BoundedSemaphore(max_concurrency)
 
+        # Replay never touches the network, so it needs no client or credentials
+        self.client = client
+        if self.client is None and self.cache_mode != 'replay':
+            self.client = self._init_client()
+
+    def _init_client(self):
         # Validate environment variables
         endpoint = os.environ.get('AZURE_OPENAI_ENDPOINT', '')
         api_key = os.environ.get('AZURE_OPENAI_API_KEY', '')
@@ -29,59 +96,205 @@ class GPT4Model(LLM_Model):
                 "Please set the environment variables AZURE_OPENAI_ENDPOINT and AZURE_OPENAI_API_KEY"
             )
 
-        # Initialize Azure OpenAI client
-        self.client = AzureOpenAI(
+        # Initialize Azure OpenAI client, shared by every model calling the same endpoint
+        api_version = "2024-05-01-preview"
+        return get_api_client(('azure', endpoint, api_key, api_version, self.http_pool), lambda: AzureOpenAI(
             azure_endpoint=endpoint,
             api_key=api_key,
-            api_version="2024-05-01-preview",
-        )
+            api_version=api_version,
+            max_retries=0,  # Retries go through the shared rate limiter instead
+            http_client=get_http_client(self.http_pool),
+        ))
 
-    def inference(self, prompt: str, temperature: float, desc: str = '') -> str:
+    def inference(self, prompt: Union[str, List[Dict[str, str]]], temperature: float, desc: str = '') -> str:
         """
         Perform inference using the GPT-4 model.
 
         Args:
-            prompt (str): The input prompt for the model.
+            prompt (Union[str, List[Dict[str, str]]]): The input prompt for the model, or its chat messages.
             temperature (float): Sampling temperature for the model.
             desc (str): Description of the inference task for logging.
 
         Returns:
             str: The generated response from the model.
         """
+        responses = self.inference_n(prompt, temperature, n=1, desc=desc)
+        return responses[0] if responses else ''
+
+    def inference_n(self, prompt: Union[str, List[Dict[str, str]]], temperature: float, n: int, desc: str = '') -> List[str]:
+        """
+        Sample several completions of one prompt in a single request.
+
+        Args:
+            prompt (Union[str, List[Dict[str, str]]]): The input prompt for the model, or its chat messages.
+            temperature (float): Sampling temperature for the model.
+            n (int): Number of completions to sample.
+            desc (str): Description of the inference task for logging.
+
+        Returns:
+            List[str]: The non-empty completions, at most n of them.
+        """
         # Log the inference call
         if self.logger:
-            self.logger.info(f"GPT4 | {desc} | Temperature: {temperature}")
+            self.logger.info(f"GPT4 | {desc} | Temperature: {temperature} | n: {n}")
+
+        messages = prompt if isinstance(prompt, list) else [{'role': 'user', 'content': prompt}]
+        if not self.cache:
+            return self._request(messages, temperature, n)
+
+        key = self._cache_key(messages, temperature, n)
+        if self.cache_mode != 'record':
+            cached = self.cache.get(key)
+            if cached is not None:
+                return json.loads(cached)
+            if self.cache_mode == 'replay':
+                raise KeyError(f"No recorded completion for request ({desc}) in {self.cache.path}")
+
+        responses = self._request(messages, temperature, n)
+        if responses:
+            self.cache.put(key, json.dumps(responses, ensure_ascii=False))
+        return responses
+
+    def cache_state(self) -> dict:
+        with self._request_counts_lock:
+            request_counts = dict(self._request_counts)
+        return {'cache_path': self.cache.path if self.cache else None, 'request_counts': request_counts}
+
+    def load_cache_state(self, state: dict) -> None:
+        """Continue the occurrence count of every request, so that a resumed run keeps replaying the completions recorded after the checkpoint."""
+        with self._request_counts_lock:
+            self._request_counts = Counter(state.get('request_counts', {}))
+
+    def _cache_key(self, messages: List[dict], temperature: float, n: int) -> str:
+        request_key = CompletionCache.make_key(self.deployment, messages, temperature, self.seed, self.max_tokens, n)
+        with self._request_counts_lock:
+            occurrence = self._request_counts[request_key]
+            self._request_counts[request_key] += 1
+        return CompletionCache.make_key(request_key, occurrence)
 
-        messages = [{'role': 'user', 'content': prompt}]
-        response = ""
-        timeout = 5
+    def _request(self, messages: List[dict], temperature: float, n: int = 1) -> List[str]:
+        """Send a chat completion request through the rate limiter, retrying failures."""
+        # Rough estimate (4 characters per token) until the actual usage is known
+        estimated_tokens = sum(len(message['content']) for message in messages) // 4 + n * self.max_tokens
 
-        while not response:
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(estimated_tokens)
+            retry_after = None
             try:
-                time.sleep(timeout)
-                completion = self.client.chat.completions.create(
-                    model="gpt-4",  # Deployment name
-                    messages=messages,
-                    seed=42,  # Ensure reproducibility
-                    temperature=temperature,
-                    max_tokens=self.max_tokens,
-                )
-                response = completion.choices[0].message.content
+                with self._request_slots:
+                    completion = self.client.chat.completions.create(
+                        model=self.deployment,
+                        messages=messages,
+                        seed=self.seed,
+                        temperature=temperature,
+                        max_tokens=self.max_tokens,
+                        n=n,
+                        timeout=self.request_timeout,
+                    )
+                if completion.usage:
+                    self.rate_limiter.record_usage(estimated_tokens, completion.usage.total_tokens)
+                    usage_tracker.record('opt', self.deployment, completion.usage.prompt_tokens, completion.usage.completion_tokens)
+                responses = [choice.message.content for choice in completion.choices if choice.message.content]
+                if responses:
+                    return responses
+                if self.logger:
+                    self.logger.error("Empty response from GPT-4.")
             except Exception as e:
                 if self.logger:
                     self.logger.error(f"Error during GPT-4 inference: {e}")
+                if getattr(e, 'status_code', None) in self.NON_RETRYABLE_STATUS_CODES:
+                    break
+                retry_after = self._get_retry_after(e)
 
-                # Exponential backoff for retries
-                timeout = min(timeout * 2, 1024)  # Cap timeout at 1024 seconds
-                if timeout > 120:
-                    timeout = 1  # Reset timeout if it grows too large
+            if attempt == self.max_retries:
+                break
+            if retry_after is not None:
+                # The next acquire() waits out the pause, for this thread and every other caller
+                self.rate_limiter.pause(retry_after)
+                timeout = retry_after
+            else:
+                timeout = backoff_delay(attempt)
+                time.sleep(timeout)
+            if self.logger:
+                self.logger.info(f"Retrying after {timeout:.1f} seconds...")
 
-                if self.logger:
-                    self.logger.info(f"Retrying after {timeout} seconds...")
+        if self.logger:
+            self.logger.error("Giving up on GPT-4 inference.")
+        return []
 
-                if timeout > 1024:
-                    if self.logger:
-                        self.logger.error("Max retries exceeded. Aborting inference.")
-                    break
+    @staticmethod
+    def _get_retry_after(error: Exception) -> Optional[float]:
+        """Read the server-requested delay from the headers of a failed request, if any."""
+        headers = getattr(getattr(error, 'response', None), 'headers', None)
+        if not headers:
+            return None
+        try:
+            if headers.get('retry-after-ms'):
+                return float(headers['retry-after-ms']) / 1000
+            if headers.get('retry-after'):
+                return float(headers['retry-after'])
+        except ValueError:
+            return None
+        return None
+
+    def inference_many(self, prompts: List[Union[str, List[Dict[str, str]]]], temperature: float, desc: str = '') -> List[str]:
+        """
+        Perform inference on several independent prompts concurrently on the shared client.
+
+        Args:
+            prompts (List[Union[str, List[Dict[str, str]]]]): The input prompts for the model, or their chat messages.
+            temperature (float): Sampling temperature for the model.
+            desc (str): Description of the inference task for logging.
+
+        Returns:
+            List[str]: The generated responses, in the order of the prompts.
+        """
+        if len(prompts) <= 1:
+            return [self.inference(prompt, temperature, desc) for prompt in prompts]
+
+        with ThreadPoolExecutor(max_workers=min(len(prompts), self.max_concurrency)) as executor:
+            return list(executor.map(bind_context(lambda prompt: self.inference(prompt, temperature, desc)), prompts))
+
+    def inference_many_n(self, prompts: List[Union[str, List[Dict[str, str]]]], temperature: float, ns: List[int], desc: str = '') -> List[List[str]]:
+        """
+        Sample several completions of several independent prompts concurrently on the shared client.
 
-        return response
\ No newline at end of file
+        Args:
+            prompts (List[Union[str, List[Dict[str, str]]]]): The input prompts for the model, or their chat messages.
+            temperature (float): Sampling temperature for the model.
+            ns (List[int]): Number of completions to sample for each prompt.
+            desc (str): Description of the inference task for logging.
+
+        Returns:
+            List[List[str]]: The completions of each prompt, in the order of the prompts.
+        """
+        if len(prompts) <= 1:
+            return [self.inference_n(prompt, temperature, n, desc) for prompt, n in zip(prompts, ns)]
+
+        with ThreadPoolExecutor(max_workers=min(len(prompts), self.max_concurrency)) as executor:
+            return list(executor.map(bind_context(lambda prompt, n: self.inference_n(prompt, temperature, n, desc)), prompts, ns))
+
+
+class OpenAIModel(GPT4Model):
+    """
+    GPT4Model served by the OpenAI API instead of Azure.
+
+    Reads OPENAI_API_KEY (and the optional OPENAI_BASE_URL), and the model name from OPENAI_MODEL (default 'gpt-4').
+    """
+    batch_url = '/v1/chat/completions'
+
+    def __init__(self, max_tokens: int, **kwargs):
+        super().__init__(max_tokens, **kwargs)
+        self.deployment = os.environ.get('OPENAI_MODEL', 'gpt-4')
+
+    def _init_client(self):
+        api_key = os.environ.get('OPENAI_API_KEY', '')
+        if not api_key:
+            raise ValueError("Please set the environment variable OPENAI_API_KEY")
+        base_url = os.environ.get('OPENAI_BASE_URL') or None
+        return get_api_client(('openai', base_url, api_key, self.http_pool), lambda: OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,  # Retries go through the shared rate limiter instead
+            http_client=get_http_client(self.http_pool),
+        ))
@@ -0,0 +1,80 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from .Vllm import VllmModel
+from .base import GenericSamplingParams, truncate_at_stop
+from .http_pool import HTTPPoolConfig, get_api_client, get_http_client
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import List, Optional
+import os
+
+
+class OpenAICompatibleEngine:
+    """
+    Serves VllmModel's engine interface from an OpenAI-compatible completions endpoint, e.g. a
+    `vllm serve`, TGI or llama.cpp server, with requests issued concurrently.
+    """
+
+    def __init__(self, model: str, base_url: str, api_key: str, max_concurrency: int = 32):
+        from openai import OpenAI
+
+        self.model = model
+        self.max_concurrency = max_concurrency
+        http_pool = HTTPPoolConfig(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        self.client = get_api_client(('openai_compatible', base_url, api_key, http_pool), lambda: OpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            http_client=get_http_client(http_pool),
+        ))
+
+    def get_tokenizer(self):
+        return None
+
+    def _complete(self, prompt: str, sampling_params: GenericSamplingParams) -> SimpleNamespace:
+        extra_body = {'repetition_penalty': sampling_params.repetition_penalty} if sampling_params.repetition_penalty != 1.0 else None
+        completion = self.client.completions.create(
+            model=self.model,
+            prompt=prompt,
+            temperature=sampling_params.temperature,
+            top_p=sampling_params.top_p,
+            max_tokens=sampling_params.max_tokens,
+            stop=sampling_params.stop or None,
+            extra_body=extra_body,
+        )
+        # Servers may return the stop string or ignore stop lists longer than they support
+        text = truncate_at_stop(completion.choices[0].text, sampling_params.stop)
+        details = getattr(completion.usage, 'prompt_tokens_details', None)
+        return SimpleNamespace(
+            outputs=[SimpleNamespace(text=text, token_ids=[0] * completion.usage.completion_tokens if completion.usage else None, finish_reason=completion.choices[0].finish_reason)],
+            prompt_token_ids=[0] * completion.usage.prompt_tokens if completion.usage else None,
+            num_cached_tokens=getattr(details, 'cached_tokens', None),
+        )
+
+    def generate(self, prompts: List[str], sampling_params: GenericSamplingParams, use_tqdm: bool = False) -> List[SimpleNamespace]:
+        with ThreadPoolExecutor(max_workers=max(1, min(len(prompts), self.max_concurrency))) as executor:
+            return list(executor.map(lambda prompt: self._complete(prompt, sampling_params), prompts))
+
+
+class OpenAICompatibleModel(VllmModel):
+    """
+    Eval model served over HTTP by an OpenAI-compatible completions server.
+
+    The server is read from the OPENAI_COMPATIBLE_BASE_URL environment variable (and the optional
+    OPENAI_COMPATIBLE_API_KEY), and model_path names the served model. Caching, stopping policies
+    and background priority work as for VllmModel; engine options such as gpu_memory_utilization
+    belong to the server and are ignored here.
+    """
+    sampling_params_cls = GenericSamplingParams
+
+    def _init_engine(self, model_path: Optional[str], enable_prefix_caching: bool, gpu_memory_utilization: float) -> None:
+        base_url = os.environ.get('OPENAI_COMPATIBLE_BASE_URL', '')
+        if not base_url:
+            raise ValueError("Please set the environment variable OPENAI_COMPATIBLE_BASE_URL, e.g. http://localhost:8000/v1")
+
+        self.llm = OpenAICompatibleEngine(
+            model=model_path,
+            base_url=base_url,
+            api_key=os.environ.get('OPENAI_COMPATIBLE_API_KEY', 'EMPTY'),
+            max_concurrency=int(os.environ.get('OPENAI_COMPATIBLE_CONCURRENCY', 32)),
+        )
@@ -0,0 +1,67 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from .Vllm import VllmModel
+from .base import GenericSamplingParams, truncate_at_stop
+from types import SimpleNamespace
+from typing import List, Optional
+import os
+
+
+class TransformersEngine:
+    """Serves VllmModel's engine interface with greedy decoding from a local Hugging Face transformers model."""
+
+    def __init__(self, model_path: str, device: str = 'cpu', batch_size: int = 8):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.torch = torch
+        self.device = device
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, padding_side='left')
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(model_path).to(device).eval()
+
+    def get_tokenizer(self):
+        return self.tokenizer
+
+    def generate(self, prompts: List[str], sampling_params: GenericSamplingParams, use_tqdm: bool = False) -> List[SimpleNamespace]:
+        outputs = []
+        for start_idx in range(0, len(prompts), self.batch_size):
+            inputs = self.tokenizer(prompts[start_idx:start_idx + self.batch_size], return_tensors='pt', padding=True).to(self.device)
+            with self.torch.no_grad():
+                generated = self.model.generate(
+                    **inputs,
+                    do_sample=False,
+                    max_new_tokens=sampling_params.max_tokens,
+                    repetition_penalty=sampling_params.repetition_penalty,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                )
+            completions = generated[:, inputs['input_ids'].shape[1]:]
+            texts = self.tokenizer.batch_decode(completions, skip_special_tokens=True)
+            num_completion_tokens = (completions != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+            for num_prompt_tokens, num_tokens, text in zip(inputs['attention_mask'].sum(dim=1).tolist(), num_completion_tokens, texts):
+                outputs.append(SimpleNamespace(
+                    outputs=[SimpleNamespace(text=truncate_at_stop(text, sampling_params.stop), token_ids=[0] * num_tokens, finish_reason='length' if num_tokens >= sampling_params.max_tokens else 'stop')],
+                    prompt_token_ids=[0] * num_prompt_tokens,
+                    num_cached_tokens=0,
+                ))
+        return outputs
+
+
+class TransformersModel(VllmModel):
+    """
+    Eval model decoded locally with Hugging Face transformers, for machines without vllm or a GPU.
+
+    The device and batch size are read from the TRANSFORMERS_DEVICE (default 'cpu') and
+    TRANSFORMERS_BATCH_SIZE (default 8) environment variables.
+    """
+    sampling_params_cls = GenericSamplingParams
+
+    def _init_engine(self, model_path: Optional[str], enable_prefix_caching: bool, gpu_memory_utilization: float) -> None:
+        self.llm = TransformersEngine(
+            model_path=model_path,
+            device=os.environ.get('TRANSFORMERS_DEVICE', 'cpu'),
+            batch_size=int(os.environ.get('TRANSFORMERS_BATCH_SIZE', 8)),
+        )
@@ -2,18 +2,31 @@
 # Licensed under the MIT license.
 
 from .base import LLM_Model
-from vllm import LLM, SamplingParams
-from typing import List, Union, Optional
+from .cache import CompletionCache
+from utils import PriorityLock
+from usage import usage_tracker
+from typing import TYPE_CHECKING, List, Union, Optional
 import os
 import logging
 
+# vllm is only imported when a vLLM engine is created, so that the engines sharing this class
+# (OpenAI-compatible, Transformers, fake) do not pay for importing it
+if TYPE_CHECKING:
+    from vllm import SamplingParams
+
 class VllmModel(LLM_Model):
+    # Engines that do not depend on vllm set this to GenericSamplingParams, vllm.SamplingParams if None
+    sampling_params_cls = None
+
     def __init__(
         self,
         model_path: Optional[str] = None,
         max_tokens: int = 256,
         stop: str = '',
         repetition_penalty: float = 1.0,
+        cache_path: Optional[str] = None,
+        enable_prefix_caching: bool = False,
+        gpu_memory_utilization: float = 0.9,
         logger: Optional[logging.Logger] = None,
     ):
         """
@@ -24,21 +37,128 @@ class VllmModel(LLM_Model):
             max_tokens (int): Maximum number of tokens to generate. Defaults to 256.
             stop (str): Stop sequence for generation. Defaults to ''.
             repetition_penalty (float): Penalty for repetition. Defaults to 1.2.
+            cache_path (Optional[str]): Path to an on-disk completion cache. Disabled if None.
+            enable_prefix_caching (bool): Whether to enable vLLM automatic prefix caching. Defaults to False.
+            gpu_memory_utilization (float): Fraction of GPU memory reserved by the engine. Defaults to 0.9.
             logger (Optional[logging.Logger]): Logger object for logging messages.
         """
         self.logger = logger
 
         # Initialize the VLLM model
-        self.llm = LLM(model=model_path)
+        self._init_engine(model_path, enable_prefix_caching, gpu_memory_utilization)
+        self.model_path = model_path
         self.max_tokens = max_tokens
         self.stop = stop
         self.repetition_penalty = repetition_penalty
 
+        self.stopping_policy = None
+
+        # Decoding is greedy, so completions are fully determined by the prompt and sampling parameters
+        self.cache = CompletionCache(cache_path) if cache_path else None
+
+        # The engine is shared by the optimizer threads; background requests yield to foreground ones
+        self._engine_lock = PriorityLock()
+
+        # Prefix cache statistics, in prompt tokens
+        self.enable_prefix_caching = enable_prefix_caching
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+
+        # Completions cut by the max_tokens budget, which usually miss their answer
+        self.num_completions = 0
+        self.num_length_stopped = 0
+
+    def _init_engine(self, model_path: Optional[str], enable_prefix_caching: bool, gpu_memory_utilization: float) -> None:
+        try:
+            from vllm import LLM
+        except ImportError as e:
+            raise ImportError("VllmModel requires vllm, please install it or use the FakeVllm eval model") from e
+        self.llm = LLM(model=model_path, enable_prefix_caching=enable_prefix_caching, gpu_memory_utilization=gpu_memory_utilization)
+
+    def get_tokenizer(self):
+        return self.llm.get_tokenizer()
+
+    def _get_stop_and_max_tokens(self):
+        stop, max_tokens = self.stop, self.max_tokens
+        if self.stopping_policy:
+            stop = ([stop] if stop else []) + self.stopping_policy.stop
+            if self.stopping_policy.max_tokens:
+                max_tokens = min(max_tokens, self.stopping_policy.max_tokens)
+        return stop, max_tokens
+
+    def _get_sampling_params(self) -> 'SamplingParams':
+        stop, max_tokens = self._get_stop_and_max_tokens()
+        sampling_params_cls = self.sampling_params_cls
+        if sampling_params_cls is None:
+            from vllm import SamplingParams as sampling_params_cls
+        return sampling_params_cls(
+            temperature=0,
+            repetition_penalty=self.repetition_penalty,
+            top_p=0.1,
+            max_tokens=max_tokens,
+            stop=stop,
+        )
+
+    def _cache_key(self, prompt: str, sampling_params: 'SamplingParams') -> str:
+        return CompletionCache.make_key(self.model_path, repr(sampling_params), prompt)
+
+    def _generate(self, prompts: List[str], sampling_params: 'SamplingParams', batch_size: int, background: bool = False) -> List[str]:
+        """Generate completions for a list of prompts, serving cached ones without touching the GPU."""
+        keys = [self._cache_key(p, sampling_params) for p in prompts] if self.cache else []
+        cached = self.cache.get_many(keys) if self.cache else {}
+        outputs = [cached.get(key) for key in keys] if self.cache else [None] * len(prompts)
+
+        # Submit prompts sharing a prefix (instructions, details, few-shot examples) next to each other,
+        # so that they land in the same batch and reuse each other's cached KV blocks
+        miss_idxs = sorted((i for i, output in enumerate(outputs) if output is None), key=lambda i: prompts[i])
+        for start_idx in range(0, len(miss_idxs), batch_size):
+            sub_idxs = miss_idxs[start_idx:start_idx + batch_size]
+            with self._engine_lock.acquire(background=background):
+                sub_gen_output_list = self.llm.generate([prompts[i] for i in sub_idxs], sampling_params, use_tqdm=False)
+            for i, item in zip(sub_idxs, sub_gen_output_list):
+                outputs[i] = item.outputs[0].text
+                if self.stopping_policy:
+                    outputs[i] = self.stopping_policy.truncate(outputs[i])
+            self._update_prefix_cache_stats(sub_gen_output_list)
+
+            if self.cache:
+                self.cache.put_many({keys[i]: outputs[i] for i in sub_idxs})
+
+        self._log_cache_stats(num_generated=len(miss_idxs))
+        return outputs
+
+    def _log_cache_stats(self, num_generated: int) -> None:
+        if self.cache and self.logger:
+            stats = self.cache.stats()
+            self.logger.info(f"VLLM | Cache hits: {stats['hits']}, misses: {stats['misses']}, hit rate: {stats['hit_rate']:.2%}")
+        if self.enable_prefix_caching and num_generated and self.logger:
+            self.logger.info(f"VLLM | Prefix cache hit rate: {self.prefix_hit_rate():.2%} of {self.prompt_tokens} prompt tokens")
+        if self.num_length_stopped and num_generated and self.logger:
+            _, max_tokens = self._get_stop_and_max_tokens()
+            self.logger.warning(f"VLLM | {self.num_length_stopped} of {self.num_completions} completions so far hit the max_tokens budget of {max_tokens}")
+
+    def _update_prefix_cache_stats(self, gen_output_list) -> None:
+        num_prompt_tokens = num_completion_tokens = 0
+        for item in gen_output_list:
+            num_prompt_tokens += len(item.prompt_token_ids or [])
+            num_completion_tokens += len(getattr(item.outputs[0], 'token_ids', None) or [])
+            # Only reported by vLLM versions that expose per-request prefix cache hits
+            self.cached_prompt_tokens += getattr(item, 'num_cached_tokens', None) or 0
+            self.num_length_stopped += getattr(item.outputs[0], 'finish_reason', None) == 'length'
+        self.num_completions += len(gen_output_list)
+        self.prompt_tokens += num_prompt_tokens
+        usage_tracker.record('eval', self.model_path, num_prompt_tokens, num_completion_tokens, num_requests=len(gen_output_list))
+
+    def prefix_hit_rate(self) -> float:
+        """Fraction of prompt tokens served from the vLLM prefix cache so far."""
+        return self.cached_prompt_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
     def inference(
         self,
         prompt: Union[str, List[str]],
         use_batch_acceleration: bool = True,
         desc: str = '',
+        background: bool = False,
     ) -> Union[str, List[str]]:
         """
         Perform inference using the VLLM model.
@@ -47,6 +167,7 @@ class VllmModel(LLM_Model):
             prompt (Union[str, List[str]]): Input prompt(s) for the model.
             use_batch_acceleration (bool): Whether to use batch acceleration. Defaults to True.
             desc (str): Description of the inference task for logging.
+            background (bool): Whether this is low-priority work that yields the GPU to other callers. Defaults to False.
 
         Returns:
             Union[str, List[str]]: Generated output(s) from the model.
@@ -56,29 +177,13 @@ class VllmModel(LLM_Model):
             self.logger.info(f"VLLM | {desc}")
 
         # Configure sampling parameters
-        sampling_params = SamplingParams(
-            temperature=0, 
-            repetition_penalty=self.repetition_penalty,
-            top_p=0.1,
-            max_tokens=self.max_tokens,
-            stop=self.stop,
-        )
-        
-        if use_batch_acceleration and isinstance(prompt, list):
-            batch_size = 512
-            gen_output_list = []
-
-            for start_idx in range(0, len(prompt), batch_size):
-                end_idx = start_idx + batch_size
-                sub_gen_input_list = prompt[start_idx:end_idx]
-                sub_gen_output_list = self.llm.generate(sub_gen_input_list, sampling_params, use_tqdm=False)
-                gen_output_list.extend(sub_gen_output_list)
+        sampling_params = self._get_sampling_params()
 
-            return [item.outputs[0].text for item in gen_output_list]
+        if use_batch_acceleration and isinstance(prompt, list):
+            return self._generate(prompt, sampling_params, batch_size=512, background=background)
 
         elif not use_batch_acceleration and isinstance(prompt, str):
-            output = self.llm.generate(prompt, sampling_params, use_tqdm=False)
-            return output[0].outputs[0].text
+            return self._generate([prompt], sampling_params, batch_size=1, background=background)[0]
 
 if __name__ == "__main__":
     llm = VllmModel("/home/aiscuser/Phi-3-mini-4k-instruct", max_tokens=512, stop='\n\n', repetition_penalty=1.0)
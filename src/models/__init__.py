@@ -6,4 +6,78 @@ __paper__ = Beyond Prompt Content: Enhancing LLM Performance via Content-Format
 __author__ = Yuanye Liu#, Jiahang Xu#
 __version__ = 1.0
 __date__ = 2025-1
-"""
\ No newline at end of file
+"""
+
+import importlib
+from importlib import metadata
+from typing import Dict
+
+
+# Built-in backends, as "module:ClassName" relative to this package. Modules are only imported
+# when their backend is selected, so a run never pays for the dependencies of the others.
+BACKENDS: Dict[str, str] = {
+    'GPT4': '.GPT4:GPT4Model',
+    'OpenAI': '.GPT4:OpenAIModel',
+    'Vllm': '.Vllm:VllmModel',
+    'AsyncVllm': '.AsyncVllm:AsyncVllmModel',
+    'OpenAICompatible': '.OpenAICompatible:OpenAICompatibleModel',
+    'Transformers': '.Transformers:TransformersModel',
+    'FakeGPT4': '.FakeGPT4:FakeGPT4Model',
+    'FakeVllm': '.FakeVllm:FakeVllmModel',
+}
+
+# Model family names that select the vLLM backend, kept for existing scripts (e.g. --eval_llm Mistral)
+ALIASES: Dict[str, str] = {
+    'Llama': 'Vllm',
+    'Mistral': 'Vllm',
+    'Phi3': 'Vllm',
+}
+
+# Third-party backends register "name = package.module:ClassName" under this entry point group
+ENTRY_POINT_GROUP = 'cfpo.models'
+
+
+def register_backend(name: str, target: str) -> None:
+    """Register a backend as "module:ClassName"; relative modules are resolved against this package."""
+    BACKENDS[name] = target
+
+
+def _entry_points() -> Dict[str, str]:
+    try:
+        eps = metadata.entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:  # Python < 3.10
+        eps = metadata.entry_points().get(ENTRY_POINT_GROUP, [])
+    return {ep.name: ep.value for ep in eps}
+
+
+def resolve_backend_name(name: str) -> str:
+    if name in BACKENDS:
+        return name
+    for alias, backend in ALIASES.items():
+        if alias in name:
+            return backend
+    return name
+
+
+def get_model_class(name: str):
+    """
+    Look up a model backend by name and import only its module.
+
+    Args:
+        name (str): A registered backend, a model family alias, an installed entry point,
+            or a "module:ClassName" path.
+
+    Returns:
+        type: The model class.
+    """
+    backend = resolve_backend_name(name)
+    target = BACKENDS.get(backend) or _entry_points().get(backend) or (backend if ':' in backend else None)
+    if target is None:
+        raise ImportError(f"Cannot find model backend named {name}, available backends: {sorted(BACKENDS)}")
+
+    module_name, class_name = target.split(':')
+    try:
+        module = importlib.import_module(module_name, package=__name__)
+        return getattr(module, class_name)
+    except AttributeError as e:
+        raise ImportError(f"Cannot find {class_name} in module {module_name} for model backend {name}") from e
@@ -2,6 +2,8 @@
 # Licensed under the MIT license.
 
 from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import List, Union
 
 class LLM_Model(ABC):
     def __init__(self, model_path=None, max_tokens=512, stop = '', repetition_penalty=1.0):
@@ -13,3 +15,52 @@ class LLM_Model(ABC):
     @abstractmethod
     def inference(self, ex, prompt):
         pass
+
+    def inference_many(self, prompts, temperature, desc=''):
+        """Run inference on several independent prompts. Backends that can serve concurrent requests override this."""
+        return [self.inference(prompt, temperature=temperature, desc=desc) for prompt in prompts]
+
+    def inference_n(self, prompt, temperature, n, desc=''):
+        """Sample n completions of one prompt. Backends that support multi-completion requests override this."""
+        return self.inference_many([prompt] * n, temperature=temperature, desc=desc)
+
+    def inference_many_n(self, prompts, temperature, ns, desc=''):
+        """Sample ns[i] completions of each of several independent prompts."""
+        return [self.inference_n(prompt, temperature, n, desc=desc) for prompt, n in zip(prompts, ns)]
+
+    def cache_state(self) -> dict:
+        """Reference to the on-disk completion cache of the model, saved with run checkpoints."""
+        cache = getattr(self, 'cache', None)
+        return {'cache_path': cache.path if cache else None}
+
+    def load_cache_state(self, state: dict) -> None:
+        """Restore the cache bookkeeping of a checkpointed run. Backends whose cache keys depend on past requests override this."""
+        pass
+
+    def get_tokenizer(self):
+        """Return the tokenizer of the model, if it is available locally."""
+        return None
+
+    def set_stopping_policy(self, stopping_policy) -> None:
+        """Apply the task-provided stop strings, max_tokens budget and answer truncation."""
+        self.stopping_policy = stopping_policy
+
+
+@dataclass
+class GenericSamplingParams:
+    """The subset of vllm.SamplingParams read by VllmModel, for engines that do not depend on vllm."""
+    temperature: float = 0
+    repetition_penalty: float = 1.0
+    top_p: float = 1.0
+    max_tokens: int = 256
+    stop: Union[str, List[str]] = field(default_factory=list)
+
+    def __post_init__(self):
+        if isinstance(self.stop, str):
+            self.stop = [self.stop] if self.stop else []
+
+
+def truncate_at_stop(text: str, stop: List[str]) -> str:
+    """Cut a completion at the first stop string, as vLLM does, for engines that cannot stop early."""
+    cut = min((text.find(s) for s in stop if s and s in text), default=len(text))
+    return text[:cut]
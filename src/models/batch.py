@@ -0,0 +1,294 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Batch submission of optimizer LLM requests.
+
+BatchModel wraps a GPT4Model: every inference call writes its requests as a JSONL batch in the
+chat-completions batch format, submits it, and blocks until the batch completes. Results are
+stored by request hash, and submitted batches are recorded in the batch directory, so a run
+restarted with the same seed collects the batches it already submitted instead of paying for
+them twice.
+"""
+
+from .base import LLM_Model
+from .cache import CompletionCache
+from usage import usage_tracker
+from typing import Dict, List, Optional, Tuple
+import os
+import json
+import time
+import uuid
+import logging
+
+
+def completion_to_dict(completion) -> Dict:
+    """Serialize a chat completion returned by an OpenAI client (or a FakeOpenAIClient) to its JSON body."""
+    if hasattr(completion, 'model_dump'):
+        return completion.model_dump()
+    usage = getattr(completion, 'usage', None)
+    return {
+        'model': getattr(completion, 'model', None),
+        'choices': [{'index': choice.index, 'message': {'role': 'assistant', 'content': choice.message.content}} for choice in completion.choices],
+        'usage': {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens} if usage else None,
+    }
+
+
+class OpenAIBatchBackend:
+    """Submits batches to the files and batches endpoints of an OpenAI or Azure OpenAI client."""
+
+    def __init__(self, client, url: str = '/v1/chat/completions', completion_window: str = '24h'):
+        self.client = client
+        self.url = url
+        self.completion_window = completion_window
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=self.url, completion_window=self.completion_window)
+        return batch.id
+
+    def poll(self, batch_id: str) -> Tuple[str, Optional[List[Dict]]]:
+        """Return the status of a batch, and its output lines once it is completed."""
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status != 'completed':
+            return batch.status, None
+        lines = self.client.files.content(batch.output_file_id).text.splitlines() if batch.output_file_id else []
+        return batch.status, [json.loads(line) for line in lines if line.strip()]
+
+
+class DirectoryBatchBackend:
+    """
+    Local stand-in for a provider batch endpoint: batches are files in a directory, and a processor
+    writes `<batch_id>.output.jsonl` next to each `<batch_id>.input.jsonl`.
+
+    With a processor client, polling processes the polled batch in-process through that client (e.g. an
+    OpenAI client outside of batch pricing, or a FakeOpenAIClient); without one, another process runs
+    `process_pending` on the same directory.
+    """
+    url = '/v1/chat/completions'
+
+    def __init__(self, root: str, processor_client=None):
+        self.root = root
+        self.processor_client = processor_client
+        os.makedirs(root, exist_ok=True)
+
+    def submit(self, input_path: str) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        with open(input_path, 'rb') as src, open(os.path.join(self.root, f"{batch_id}.input.jsonl"), 'wb') as dst:
+            dst.write(src.read())
+        return batch_id
+
+    def poll(self, batch_id: str) -> Tuple[str, Optional[List[Dict]]]:
+        output_path = os.path.join(self.root, f"{batch_id}.output.jsonl")
+        if not os.path.exists(output_path) and self.processor_client is not None:
+            process_batch(self.root, batch_id, self.processor_client)
+        if not os.path.exists(output_path):
+            return 'in_progress', None
+        with open(output_path) as f:
+            return 'completed', [json.loads(line) for line in f if line.strip()]
+
+
+def process_pending(root: str, client) -> int:
+    """Answer every unprocessed batch in a DirectoryBatchBackend directory through client. Returns the number of batches processed."""
+    batch_ids = [name[:-len('.input.jsonl')] for name in sorted(os.listdir(root)) if name.endswith('.input.jsonl')]
+    return sum(process_batch(root, batch_id, client) for batch_id in batch_ids)
+
+
+def process_batch(root: str, batch_id: str, client) -> bool:
+    """
+    Answer one batch of a DirectoryBatchBackend directory through client.
+
+    The batch is claimed by renaming its input to `<batch_id>.processing.jsonl`, so that when several
+    threads or processes poll the same batch, only one of them sends its requests. The input gets its
+    name back once the output is written.
+
+    Returns:
+        bool: Whether this call processed the batch, False if it was done or claimed by another caller.
+    """
+    input_path = os.path.join(root, f"{batch_id}.input.jsonl")
+    processing_path = os.path.join(root, f"{batch_id}.processing.jsonl")
+    output_path = os.path.join(root, f"{batch_id}.output.jsonl")
+    if os.path.exists(output_path):
+        return False
+    try:
+        os.rename(input_path, processing_path)
+    except FileNotFoundError:
+        return False
+
+    try:
+        # The output may have been written between the check above and the claim
+        if os.path.exists(output_path):
+            return False
+
+        output_lines = []
+        with open(processing_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    body = completion_to_dict(client.chat.completions.create(**request['body']))
+                    output_lines.append({'custom_id': request['custom_id'], 'response': {'status_code': 200, 'body': body}, 'error': None})
+                except Exception as e:
+                    output_lines.append({'custom_id': request['custom_id'], 'response': None, 'error': {'message': str(e)}})
+
+        # Written under a temporary name first, so that pollers never read a partial output
+        tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.writelines(json.dumps(line, ensure_ascii=False) + '\n' for line in output_lines)
+        os.replace(tmp_path, output_path)
+        return True
+    finally:
+        os.replace(processing_path, input_path)
+
+
+class BatchModel(LLM_Model):
+    """
+    Serves the inference methods of a GPT4Model through a batch backend. Each call is one batch,
+    so the independent meta prompts of a mutator step (all feedback applications, all variations,
+    both new formats) are submitted together.
+    """
+    FAILED_STATUSES = ('failed', 'expired', 'cancelled')
+
+    def __init__(self, model, backend, batch_dir: str, poll_interval: float = 30.0, logger: Optional[logging.Logger] = None):
+        """
+        Initialize the batch model.
+
+        Args:
+            model (GPT4Model): The model whose deployment, sampling settings and request keys are used.
+            backend: An OpenAIBatchBackend or DirectoryBatchBackend.
+            batch_dir (str): Directory of the batch inputs, the record of submitted batches and the collected results.
+            poll_interval (float): Seconds between two status checks of a batch. Defaults to 30.
+            logger (Optional[logging.Logger]): Logger object for logging messages.
+        """
+        self.model = model
+        self.backend = backend
+        self.batch_dir = batch_dir
+        self.poll_interval = poll_interval
+        self.logger = logger
+        os.makedirs(batch_dir, exist_ok=True)
+
+        # Collected results by request hash; the wrapped model's cache if it has one
+        self.results = model.cache or CompletionCache(os.path.join(batch_dir, 'results.sqlite'))
+        self.submitted_path = os.path.join(batch_dir, 'submitted.jsonl')
+
+    def inference(self, prompt, temperature: float, desc: str = '') -> str:
+        responses = self.inference_n(prompt, temperature, 1, desc)
+        return responses[0] if responses else ''
+
+    def inference_n(self, prompt, temperature: float, n: int, desc: str = '') -> List[str]:
+        return self.inference_many_n([prompt], temperature, [n], desc)[0]
+
+    def inference_many(self, prompts: List, temperature: float, desc: str = '') -> List[str]:
+        return [responses[0] if responses else '' for responses in self.inference_many_n(prompts, temperature, [1] * len(prompts), desc)]
+
+    def inference_many_n(self, prompts: List, temperature: float, ns: List[int], desc: str = '') -> List[List[str]]:
+        """
+        Sample ns[i] completions of each prompt in one batch, serving already collected requests from the results store.
+
+        Args:
+            prompts (List): The input prompts for the model, or their chat messages.
+            temperature (float): Sampling temperature for the model.
+            ns (List[int]): Number of completions to sample for each prompt.
+            desc (str): Description of the inference task for logging.
+
+        Returns:
+            List[List[str]]: The completions of each prompt, in the order of the prompts.
+        """
+        requests = {}
+        for prompt, n in zip(prompts, ns):
+            messages = prompt if isinstance(prompt, list) else [{'role': 'user', 'content': prompt}]
+            key = self.model._cache_key(messages, temperature, n)
+            requests[key] = {
+                'model': self.model.deployment,
+                'messages': messages,
+                'temperature': temperature,
+                'max_tokens': self.model.max_tokens,
+                'n': n,
+                'seed': self.model.seed,
+            }
+
+        results = self.results.get_many(list(requests))
+        missing = [key for key in requests if key not in results]
+        if missing:
+            if self.logger:
+                self.logger.info(f"BATCH | {desc} | {len(results)} collected, {len(missing)} to request")
+            results.update(self._run(missing, requests))
+        return [json.loads(results[key]) if key in results else [] for key in requests]
+
+    def cache_state(self) -> dict:
+        return {**self.model.cache_state(), 'cache_path': self.results.path}
+
+    def load_cache_state(self, state: dict) -> None:
+        self.model.load_cache_state(state)
+
+    def _submitted_batches(self) -> Dict[str, List[str]]:
+        batches = {}
+        if os.path.exists(self.submitted_path):
+            with open(self.submitted_path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        batches[record['batch_id']] = record['custom_ids']
+        return batches
+
+    def _run(self, keys: List[str], requests: Dict[str, Dict]) -> Dict[str, str]:
+        """Wait for the batches that already hold some of the keys, submit the others, and collect the results."""
+        pending, covered = [], set()
+        for batch_id, custom_ids in self._submitted_batches().items():
+            if covered.issuperset(keys):
+                break
+            if set(custom_ids) & set(keys):
+                pending.append(batch_id)
+                covered.update(custom_ids)
+
+        uncovered = [key for key in keys if key not in covered]
+        if uncovered:
+            pending.append(self._submit(uncovered, requests))
+
+        collected = {}
+        for batch_id in pending:
+            collected.update(self._collect(batch_id))
+        return {key: collected[key] for key in keys if key in collected}
+
+    def _submit(self, keys: List[str], requests: Dict[str, Dict]) -> str:
+        input_path = os.path.join(self.batch_dir, f"input_{uuid.uuid4().hex}.jsonl")
+        with open(input_path, 'w') as f:
+            for key in keys:
+                f.write(json.dumps({'custom_id': key, 'method': 'POST', 'url': self.backend.url, 'body': requests[key]}, ensure_ascii=False) + '\n')
+
+        batch_id = self.backend.submit(input_path)
+        with open(self.submitted_path, 'a') as f:
+            f.write(json.dumps({'batch_id': batch_id, 'custom_ids': keys}) + '\n')
+        if self.logger:
+            self.logger.info(f"BATCH | Submitted {batch_id} with {len(keys)} requests")
+        return batch_id
+
+    def _collect(self, batch_id: str) -> Dict[str, str]:
+        """Block until a batch completes, and store the non-empty completions of its requests."""
+        while True:
+            status, output_lines = self.backend.poll(batch_id)
+            if status == 'completed':
+                break
+            if status in self.FAILED_STATUSES:
+                if self.logger:
+                    self.logger.error(f"BATCH | {batch_id} ended with status {status}")
+                return {}
+            time.sleep(self.poll_interval)
+
+        collected = {}
+        for line in output_lines:
+            body = (line.get('response') or {}).get('body')
+            if line.get('error') or not body:
+                if self.logger:
+                    self.logger.error(f"BATCH | Request {line['custom_id']} of {batch_id} failed: {line.get('error')}")
+                continue
+            responses = [choice['message']['content'] for choice in body['choices'] if choice['message'].get('content')]
+            if responses:
+                collected[line['custom_id']] = json.dumps(responses, ensure_ascii=False)
+            if body.get('usage'):
+                usage_tracker.record('opt', self.model.deployment, body['usage']['prompt_tokens'], body['usage']['completion_tokens'])
+
+        self.results.put_many(collected)
+        return collected
@@ -0,0 +1,76 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional
+
+
+class CompletionCache:
+    """
+    Persistent, content-addressed store of model completions backed by SQLite.
+
+    Entries are keyed by the hash of everything that determines a completion, so a
+    cache file can be shared across rounds, mutators and restarted runs.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open (or create) the cache database.
+
+        Args:
+            path (str): Path to the SQLite file.
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        cache_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """Hash the parts that determine a completion into a cache key."""
+        payload = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Look up several keys at once, updating the hit/miss counters."""
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM completions WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update(rows)
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def get(self, key: str) -> Optional[str]:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: Dict[str, str]) -> None:
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO completions (key, value) VALUES (?, ?)", list(items.items()))
+            self._conn.commit()
+
+    def put(self, key: str, value: str) -> None:
+        self.put_many({key: value})
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,206 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+In-process stand-in for the OpenAI chat-completions client, for offline runs, load tests and
+benchmarks of the optimizer's own overhead.
+
+Latency, error rate and throughput are configurable (see PROFILES), and the default responder
+answers the mutators' meta prompts deterministically in the <START>/<END> formats they parse.
+"""
+
+import re
+import time
+import random
+import hashlib
+import threading
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+
+PROFILES: Dict[str, Dict] = {
+    'instant': {},
+    'typical': {'latency': 2.0, 'latency_jitter': 1.0},
+    'flaky': {'latency': 1.0, 'latency_jitter': 0.5, 'error_rate': 0.2},
+    'throttled': {'latency': 1.0, 'latency_jitter': 0.5, 'max_concurrency': 4, 'retry_after': 2.0},
+}
+
+
+class FakeAPIError(Exception):
+    """Mimics the status code and response headers of an OpenAI APIStatusError."""
+
+    def __init__(self, message: str, status_code: int, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = SimpleNamespace(status_code=status_code, headers=headers or {})
+
+
+def stable_hash(*parts) -> int:
+    return int(hashlib.sha256("\x00".join(map(str, parts)).encode("utf-8")).hexdigest()[:16], 16)
+
+
+def _existing_segment(text: str) -> Tuple[str, str]:
+    """Name and content of the segment a meta prompt asks to revise, empty if there is none."""
+    match = re.search(r'The existing (\w+) (?:segment|set) contains:\n"""(.*?)"""', text, re.DOTALL)
+    return (match.group(1), match.group(2).strip()) if match else ('', '')
+
+
+class TaggedResponder:
+    """
+    Deterministic responses to the mutators' meta prompts: feedbacks, revised and varied segments,
+    new formats and their code. Each response depends only on the request and the completion index.
+    """
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+
+    def __call__(self, messages: List[Dict[str, str]], index: int) -> str:
+        text = "\n\n".join(message['content'] for message in messages)
+        rng = random.Random(stable_hash(self.seed, text, index))
+
+        if '<Renderer code>' in text:
+            name = re.findall(r'<Format name: (\w+)>', text)[-1]
+            description = re.findall(r'<Description: (.*?)>', text)[-1]
+            code = self._prompt_renderer_code(name) if 'PROMPT_RENDERER candidates' in text else self._query_format_code(name)
+            return f"<START>\n<Format name: {name}>\n<Description: {description}>\n{code}\n<END>"
+
+        if '<Format name: [format name]>' in text:
+            kind = 'prompt' if 'PROMPT_RENDERER candidates' in text else 'query'
+            name = f"fake_{kind}_{rng.randrange(10 ** 6):06d}"
+            return f"<START>\n<Format name: {name}>\n<Description: A deterministic {kind} format for offline runs.>\nInput: ...\nOutput: ...\n<END>"
+
+        if '<Prompt segment: [Segment name]>' in text:
+            segments = [key for key in re.findall(r'^\d+\. ([A-Z_]+): ', text, re.MULTILINE) if key not in ('PROMPT_RENDERER', 'QUERY_FORMAT')]
+            segment = rng.choice(segments or ['TASK_INSTRUCTION'])
+            return f"<START>\n<Prompt segment: {segment}>\nState the expected answer format explicitly (suggestion {rng.randrange(1000)}).\n<END>"
+
+        # Examples are echoed unchanged, so that they still parse with the prompt's query format
+        segment, existing = _existing_segment(text)
+        match = re.search(r'The (\d+) revised', text)
+        if match:
+            revisions = [existing if segment == 'EXAMPLES' else f"{existing} (revision {rng.randrange(1000)})" for _ in range(int(match.group(1)))]
+            return "\n".join(f"<START>\n{revision.strip()}\n<END>" for revision in revisions)
+
+        if 'The varied' in text:
+            return existing if segment == 'EXAMPLES' else f"{existing} (variation {rng.randrange(1000)})".strip()
+
+        return f"<START>\nResponse {rng.randrange(1000)}\n<END>"
+
+    @staticmethod
+    def _prompt_renderer_code(name: str) -> str:
+        return f'''<Renderer code>
+def {name}_renderer(task_instruction, task_detail, output_format, examples, query_part):
+    parts = [task_instruction, task_detail, output_format, examples, query_part]
+    return "\\n\\n".join(part.strip() for part in parts if part and part.strip())
+<Extractor code>
+def {name}_extractor(prompt):
+    return prompt.strip()'''
+
+    @staticmethod
+    def _query_format_code(name: str) -> str:
+        return f'''<Renderer code>
+def {name}_renderer(question, answer='', cot_hinter='', choices=None):
+    cot_hinter = cot_hinter.strip() + " " if cot_hinter else ""
+    option_str = "".join(f"\\n{{letter}}. {{choice}}" for letter, choice in zip("ABCDE", choices or []))
+    return f"Input: {{question}}{{option_str}}\\nOutput: {{cot_hinter}}{{answer}}".strip()
+<Extractor code>
+def {name}_extractor(text, cot_hinter=''):
+    example_list = []
+    for question, answer in re.findall(r'Input: (.*?)\\nOutput: (.*?)(?=\\nInput:|$)', text, re.DOTALL):
+        if cot_hinter:
+            answer = answer.replace(cot_hinter, '')
+        example_list.append({{"question": question.strip(), "answer": answer.strip()}})
+    return example_list'''
+
+
+class ScriptedResponder:
+    """Replays a fixed list of responses in order, cycling when it runs out."""
+
+    def __init__(self, responses: Sequence[str]):
+        self.responses = list(responses)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, messages: List[Dict[str, str]], index: int) -> str:
+        with self._lock:
+            response = self.responses[self._next % len(self.responses)]
+            self._next += 1
+        return response
+
+
+class FakeOpenAIClient:
+    """Drop-in for the `client.chat.completions.create` surface of the OpenAI clients used by GPT4Model."""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        max_concurrency: Optional[int] = None,
+        retry_after: float = 1.0,
+        responder: Optional[Union[Callable[[List[Dict[str, str]], int], str], Sequence[str]]] = None,
+        seed: int = 0,
+    ):
+        """
+        Initialize the fake client.
+
+        Args:
+            latency (float): Mean seconds per request. Defaults to 0.
+            latency_jitter (float): Uniform jitter added to the latency, in seconds. Defaults to 0.
+            error_rate (float): Probability that a request fails with a server error. Defaults to 0.
+            max_concurrency (Optional[int]): Requests in flight beyond this get a 429 with Retry-After. Unlimited if None.
+            retry_after (float): Retry-After, in seconds, sent with 429 responses. Defaults to 1.
+            responder (Optional[Union[Callable, Sequence[str]]]): Called with (messages, completion index) to produce
+                each completion, or a list of scripted responses. Defaults to a TaggedResponder.
+            seed (int): Seed of the latency and error draws. Defaults to 0.
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.retry_after = retry_after
+        if responder is None:
+            responder = TaggedResponder(seed)
+        elif not callable(responder):
+            responder = ScriptedResponder(responder)
+        self.responder = responder
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.num_requests = 0
+        self.num_errors = 0
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model: str, messages: List[Dict[str, str]], temperature: float = 1.0, max_tokens: int = 256, n: int = 1, seed: Optional[int] = None, **kwargs):
+        with self._lock:
+            self.num_requests += 1
+            throttled = self.max_concurrency is not None and self._in_flight >= self.max_concurrency
+            failed = not throttled and self._rng.random() < self.error_rate
+            delay = self.latency + self._rng.uniform(0, self.latency_jitter)
+            if throttled or failed:
+                self.num_errors += 1
+            else:
+                self._in_flight += 1
+
+        if throttled:
+            raise FakeAPIError("Rate limit exceeded", 429, {'retry-after': str(self.retry_after)})
+        if failed:
+            time.sleep(delay / 2)
+            raise FakeAPIError("Internal server error", 500)
+
+        try:
+            time.sleep(delay)
+            contents = [self.responder(messages, index) for index in range(n)]
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+        prompt_tokens = sum(len(message['content']) for message in messages) // 4
+        completion_tokens = sum(min(len(content) // 4, max_tokens) for content in contents)
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(index=i, message=SimpleNamespace(role='assistant', content=content), finish_reason='stop') for i, content in enumerate(contents)],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens),
+        )
@@ -0,0 +1,74 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Process-wide pool of HTTP connections and API clients.
+
+Every model that talks to the same endpoint with the same credentials gets the same client, backed
+by one httpx connection pool: bursts of concurrent mutator requests reuse kept-alive connections
+(multiplexed over HTTP/2 when the h2 package is installed) instead of opening a TLS session each.
+"""
+
+import threading
+import importlib.util
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable
+
+
+@dataclass(frozen=True)
+class HTTPPoolConfig:
+    """Connection limits and timeouts of a shared httpx client."""
+    max_connections: int = 64
+    max_keepalive_connections: int = 32
+    keepalive_expiry: float = 60.0
+    http2: bool = True
+    connect_timeout: float = 10.0
+    timeout: float = 120.0
+
+
+_http_clients: Dict[HTTPPoolConfig, Any] = {}
+_api_clients: Dict[Hashable, Any] = {}
+# Reentrant, as client factories fetch their httpx client while the API client is being created
+_lock = threading.RLock()
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec('h2') is not None
+
+
+def get_http_client(config: HTTPPoolConfig = HTTPPoolConfig()):
+    """Return the process-wide httpx client for the given pool configuration, creating it on first use."""
+    import httpx
+
+    with _lock:
+        if config not in _http_clients:
+            _http_clients[config] = httpx.Client(
+                http2=config.http2 and http2_available(),
+                limits=httpx.Limits(
+                    max_connections=config.max_connections,
+                    max_keepalive_connections=config.max_keepalive_connections,
+                    keepalive_expiry=config.keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(config.timeout, connect=config.connect_timeout),
+            )
+        return _http_clients[config]
+
+
+def get_api_client(key: Hashable, factory: Callable[[], Any]):
+    """
+    Return the process-wide API client registered under key, e.g. (endpoint, api key, api version),
+    creating it with factory on first use.
+    """
+    with _lock:
+        if key not in _api_clients:
+            _api_clients[key] = factory()
+        return _api_clients[key]
+
+
+def close_all() -> None:
+    """Close every pooled connection, e.g. at the end of a run."""
+    with _lock:
+        for client in _http_clients.values():
+            client.close()
+        _http_clients.clear()
+        _api_clients.clear()
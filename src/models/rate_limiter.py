@@ -0,0 +1,81 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import time
+import random
+import threading
+from typing import Optional
+
+# Backoff jitter draws from its own generator, so that retries neither consume nor depend on the global random state
+_jitter = random.Random()
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter on requests-per-minute and tokens-per-minute, shared by all threads
+    calling the same deployment.
+
+    Each bucket refills continuously up to one minute of quota. A request waits until both
+    buckets hold enough budget, and a server-side Retry-After pauses every caller at once.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        """
+        Initialize the limiter with full buckets.
+
+        Args:
+            requests_per_minute (Optional[int]): Request quota per minute. Unlimited if None.
+            tokens_per_minute (Optional[int]): Token quota (prompt + completion) per minute. Unlimited if None.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_budget = float(requests_per_minute or 0)
+        self._token_budget = float(tokens_per_minute or 0)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._request_budget = min(self.requests_per_minute, self._request_budget + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._token_budget = min(self.tokens_per_minute, self._token_budget + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, num_tokens: int = 0) -> None:
+        """Block until one request of about num_tokens tokens fits in the quota, then consume it."""
+        # A request larger than the whole bucket would otherwise never be admitted
+        num_tokens = min(num_tokens, self.tokens_per_minute) if self.tokens_per_minute else 0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    wait = 0.0
+                    if self.requests_per_minute and self._request_budget < 1:
+                        wait = max(wait, (1 - self._request_budget) * 60 / self.requests_per_minute)
+                    if self.tokens_per_minute and self._token_budget < num_tokens:
+                        wait = max(wait, (num_tokens - self._token_budget) * 60 / self.tokens_per_minute)
+                    if wait == 0:
+                        self._request_budget -= 1
+                        self._token_budget -= num_tokens
+                        return
+            time.sleep(wait)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Correct the token bucket once the actual usage of a request is known."""
+        if self.tokens_per_minute:
+            with self._lock:
+                self._token_budget -= actual_tokens - min(estimated_tokens, self.tokens_per_minute)
+
+    def pause(self, seconds: float) -> None:
+        """Hold back all callers for the given number of seconds, e.g. on a Retry-After from the server."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Exponential backoff with full jitter for the given (0-based) retry attempt."""
+    return _jitter.uniform(0, min(cap, base * 2 ** attempt))
@@ -2,6 +2,39 @@
 # Licensed under the MIT license.
 
 from utils import get_component_desc
+from contextlib import contextmanager
+from typing import Dict, List
+import contextvars
+import textwrap
+import random
+
+# RNG of the expansion task running in the current context, see seeded_rng
+_task_rng: contextvars.ContextVar = contextvars.ContextVar('mutator_rng', default=None)
+
+@contextmanager
+def seeded_rng(seed: int):
+    """Draw the mutators' random choices inside the block from an RNG seeded with seed, independently of other threads."""
+    token = _task_rng.set(random.Random(seed))
+    try:
+        yield
+    finally:
+        _task_rng.reset(token)
+
+def compile_template(template: str) -> str:
+    """Dedent a meta prompt template once at import time, so that interpolated content keeps its own whitespace."""
+    return textwrap.dedent(template).strip()
+
+META_PROMPT_HEADER_TEMPLATE = compile_template("""
+    I'm trying to write a prompt to {task_intention}.
+
+    My current prompt comprises several essential segment, including:
+    {component_desc}
+""")
+
+WHOLE_PROMPT_TEMPLATE = compile_template('''
+    The whole prompt is:
+    """{prompt}"""
+''')
 
 class BaseMutator:
     def __init__(self, mutation_llm, task, COMPONENT_KEYS):
@@ -9,18 +42,27 @@ class BaseMutator:
         self.task = task
         self.COMPONENT_KEYS = COMPONENT_KEYS
         self.component_desc = self.get_component_desc()
-    
+
+    @property
+    def rng(self):
+        """The RNG of the current expansion task, or the global random module outside of seeded_rng."""
+        return _task_rng.get() or random
+
     def get_component_desc(self):
         descs = "\n".join([f"{i+1}. {item.upper()}: {get_component_desc(item)}" for i, item in enumerate(self.COMPONENT_KEYS)])
         return descs
 
-    def _get_meta_prompt_header(self, prompt):
-
-        return f"""
-        I'm trying to write a prompt to {self.task.task_intention}.
+    def _get_meta_prompt_header(self) -> str:
+        return META_PROMPT_HEADER_TEMPLATE.format(task_intention=self.task.task_intention, component_desc=self.component_desc)
 
-        My current prompt comprises several essential segment, including:
-        {self.component_desc}
-        
-        The whole prompt is:
-        \"\"\"{str(prompt)}\"\"\"""".strip()
\ No newline at end of file
+    def _get_meta_messages(self, instruction: str, prompt=None) -> List[Dict[str, str]]:
+        """
+        Assemble a meta prompt as chat messages. The header (system message) and the whole prompt come
+        first, so that all meta prompts about one prompt share a byte-identical prefix for provider-side
+        prompt caching, and the per-call instruction comes last.
+        """
+        content = instruction if prompt is None else f"{WHOLE_PROMPT_TEMPLATE.format(prompt=str(prompt).strip())}\n\n{instruction}"
+        return [
+            {'role': 'system', 'content': self._get_meta_prompt_header()},
+            {'role': 'user', 'content': content},
+        ]
@@ -1,14 +1,163 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
-from .base import BaseMutator
+from .base import BaseMutator, compile_template
+from . import generated_formats
 from utils import parse_tagged_text, stringify_dict
 import re
 import math
-import random
 import inspect
 from typing import Optional, Tuple, Callable, Dict, Any, List
 
+FORMAT_META_PROMPT_HEADER_TEMPLATE = compile_template("""
+    I'm trying to write a prompt to {task_intention}.
+    The ultimate aim is to create a prompt that is clear, structured, and efficient, leading to accurate responses from the AI model. The structure of the prompt includes several essential elements: {component_desc}
+""")
+
+PROMPT_RENDERER_TEMPLATE = compile_template("""
+    We have some preset PROMPT_RENDERER candidates, here are our whole search pool:
+    {format_fn_desc_string}
+
+    Here are two examples from our PROMPT_RENDERER candidates as for your reference:
+    <Format name: markdown>
+    ##### Task Instruction
+    {{TASK_INSTRUCTION}}
+
+    ##### Task Detail
+    {{TASK_DETAIL}}
+
+    ##### Output Format
+    {{OUTPUT_FORMAT}}
+
+    ##### Examples
+    {{EXAMPLES}}
+
+    <Format name: xml>
+    <TaskInstruction>{{TASK_INSTRUCTION}}</TaskInstruction>
+    <TaskDetail>{{TASK_DETAIL}}</TaskDetail>
+    <OutputFormat>{{OUTPUT_FORMAT}}</OutputFormat>
+    <Examples>{{EXAMPLES}}</Examples>
+
+    Please generate ONE new format for the PROMPT_RENDERER segment, its description and render the {{TASK_INSTRUCTION}}, {{TASK_DETAIL}}, {{OUTPUT_FORMAT}} and {{EXAMPLES}} segments using this new format. The new format could either be distinct from the existing formats, or a variation of an existing format.
+
+    If you choose a completely new format, ensure that the new format is conventional, structured, and aligned with commonly used prompt formats. Avoid overly creative or unconventional formats that deviate significantly from standard practices.
+
+    If it's a variation of an existing format, the variation can change the order of the segments, or drop some segments.
+
+    {task_specific_instruction}
+
+    The format name should only include alphanumeric characters and underscores. Special characters such as `|`, `!`, `#`, `@`, and spaces should be avoided.
+
+    Please encapsulate the new prompt format using the following format:
+
+    <START>
+    <Format name: [format name]>
+    <Description: [format description]>
+    [The rendered segments rendered by the newly generated format]
+    <END>
+""")
+
+PROMPT_RENDERER_CODE_TEMPLATE = compile_template("""
+    We have some preset PROMPT_RENDERER candidates, here are our whole search pool:
+    {format_fn_desc_string}
+
+    Here are two code implementations from our PROMPT_RENDERER candidates as for your reference:
+    <Format name: markdown>
+    <Renderer code>
+    {renderer_code_1}
+    <Extractor code>
+    {extractor_code_1}
+
+    <Format name: xml>
+    <Renderer code>
+    {renderer_code_2}
+    <Extractor code>
+    {extractor_code_2}
+
+    Here is a example rendered by a new format:
+    {rendered_example}
+
+    Please generate the code for this provided example based on the new PROMPT_RENDERER. Ensure that both the renderer and extractor functions are included. The generated code should be plain Python code without any Markdown syntax or language identifiers such as ```python or '''python. Please output the code directly without any additional formatting. Note that the name of the functions must be completely SAME with the name of format, i.e. [Format name]_renderer and [Format_name]_extractor.
+    Please encapsulate the using the following format:
+
+    <START>
+    <Format name: {format_name}>
+    <Description: {format_description}>
+    <Renderer code>
+    [Renderer code]
+    <Extractor code>
+    [Extractor code]
+    <END>
+""")
+
+QUERY_FORMAT_TEMPLATE = compile_template("""
+    We have some preset QUERY_FORMAT candidates, here are our whole search pool:
+    {format_fn_desc_string}
+
+    Here are two examples from our QUERY_FORMAT candidates as for your reference:
+    <Format name: {format_name_1}>
+    {rendered_example_1}
+
+    <Format name: {format_name_2}>
+    {rendered_example_2}
+
+    Please generate ONE new format for the QUERY_FORMAT segment, its description and render the provided example using this new format. The new format could either be a completely new format or a variation of an existing format.
+
+    If you choose to generate a completely new format, please ensure that the new format is conventional, structured, and aligned with commonly used query formats. Avoid overly creative or unconventional formats that deviate significantly from standard practices. The new format should be distinct from the existing formats.
+
+    The variation can focus on two parts, CASING and SEPARATOR:
+
+    CASING refers to both the capitalization of the text (e.g., f(x) = x.title(), f(x) = x.upper(), f(x) = x.lower()) and the specific wording or phrasing used (e.g., changing "question" to "instruction" or "input").
+
+    SEPARATOR: the punctuation or symbols used to separate the question and answer, there are some candidates as for your reference {{'', ' ', '\\n', '--', ';\\n', ' ||', '<sep>', ' \\n', ':', '.'}}.
+
+    {task_specific_instruction}
+
+    The format name should only include alphanumeric characters and underscores. Special characters such as `|`, `!`, `#`, `@`, and spaces should be avoided.
+
+    Please encapsulate the new query format using the following format:
+
+    <START>
+    <Format name: [format name]>
+    <Description: [format description]>
+    [The example rendered by the newly generated format]
+    <END>
+""")
+
+QUERY_FORMAT_CODE_TEMPLATE = compile_template("""
+    We have some preset QUERY_FORMAT candidates, here are our whole search pool:
+    {format_fn_desc_string}
+
+    Here are two code implementations from our QUERY_FORMAT candidates as for your reference:
+    <Format name: {format_name_1}>
+    <Renderer code>
+    {renderer_code_1}
+    <Extractor code>
+    {extractor_code_1}
+
+    <Format name: {format_name_2}>
+    <Renderer code>
+    {renderer_code_2}
+    <Extractor code>
+    {extractor_code_2}
+
+    Here is the example rendered by the new format:
+    {rendered_example}
+
+    Please generate the code for this provided example based on the new QUERY_FORMAT. Ensure that both the renderer and extractor functions are included. The generated code should be plain Python code without any Markdown syntax or language identifiers such as ```python or '''python. Please output the code directly without any additional formatting.
+
+    Please encapsulate the using the following format:
+
+    <START>
+    <Format name: {format_name}>
+    <Description: {format_description}>
+    <Renderer code>
+    [Renderer code]
+    <Extractor code>
+    [Extractor code]
+    <END>
+""")
+
 class FormatMutator(BaseMutator):
     def __init__(
         self,
@@ -95,8 +244,10 @@ class FormatMutator(BaseMutator):
         """Apply formats to prompts and generate new prompts."""
         new_prompts = []
 
-        def apply_format(prompt, format_type: str, format_func: Tuple[Callable, Callable], action_desc: str) -> Optional[str]:
+        def apply_format(prompt, format_type: str, format_func: Optional[Tuple[Callable, Callable]], action_desc: str) -> Optional[Any]:
             """Helper function to apply a format to a prompt and handle exceptions."""
+            if format_func is None:
+                return None
             try:
                 new_prompt = prompt.generate(
                     round=round,
@@ -105,7 +256,7 @@ class FormatMutator(BaseMutator):
                     action_desc=action_desc,
                 )
                 new_prompt.render_all()
-                return str(new_prompt) if str(new_prompt) != str(prompt) else None
+                return new_prompt if new_prompt.content_hash() != prompt.content_hash() else None
             except Exception as e:
                 self.logger.error(f"Error generating prompt with {format_type.lower()}: {e}")
                 return None
@@ -137,53 +288,44 @@ class FormatMutator(BaseMutator):
         return new_prompts
 
     def generate_new_format(self) -> Optional[Tuple]:
-        def generate_format(generate_func: Callable, generate_code_func: Callable, search_pool_key: str, format_pool_key: str, **kwargs) -> Optional[Tuple[Callable, Callable]]:
-            generated_format = generate_func()
-            if not generated_format:
-                return None
-
-            generated_code = generate_code_func(generated_format, self.search_pool[search_pool_key], self.search_pool[f"{search_pool_key}_desc"], **kwargs)
-            if not generated_code:
-                return None
-
-            name, description, render_code, extractor_code = generated_code
-            namespace: Dict[str, Any] = {}
-
-            try:
-                exec(render_code, globals(), namespace)
-                exec(extractor_code, globals(), namespace)
-            except Exception as e:
-                self.logger.error(f"Error executing generated code: {e}")
-                return None
-
-            import pdb;pdb.set_trace()
-            renderer_func = namespace[f"{name}_renderer"]
-            extractor_func = namespace[f"{name}_extractor"]
-
-            if callable(renderer_func) and callable(extractor_func):
-                self.search_pool[search_pool_key].append((renderer_func, extractor_func))
-                self.search_pool[f"{search_pool_key}_desc"][renderer_func] = description
-                self.format_pool[format_pool_key][renderer_func] = {'confidence_score': 0, 'chosen_count': 0, 'uct_score': 0}
-                return (renderer_func, extractor_func)
+        """Generate a new PROMPT_RENDERER and a new QUERY_FORMAT. The two are independent, so each step is requested for both at once."""
+        format_specs = [
+            ('prompt', 'PROMPT_RENDERER', self._get_prompt_renderer_prompt, self._get_prompt_renderer_code_prompt),
+            ('query', 'QUERY_FORMAT', self._get_query_format_prompt, self._get_query_format_code_prompt),
+        ]
+
+        responses = self.mutation_llm.inference_many([spec[2]() for spec in format_specs], desc="generate format", temperature=1)
+        generated_formats = [(spec, self._parse_new_format(response)) for spec, response in zip(format_specs, responses)]
+        generated_formats = [(spec, generated_format) for spec, generated_format in generated_formats if generated_format]
+
+        code_prompts = [
+            get_code_prompt(generated_format, self.search_pool[search_pool_key], self.search_pool[f"{search_pool_key}_desc"])
+            for (search_pool_key, _, _, get_code_prompt), generated_format in generated_formats
+        ]
+        code_responses = self.mutation_llm.inference_many(code_prompts, desc="generate format code", temperature=1)
+
+        new_formats = {}
+        for ((search_pool_key, format_pool_key, _, _), _), response in zip(generated_formats, code_responses):
+            generated_code = self._parse_new_format_code(response)
+            if generated_code:
+                new_formats[format_pool_key] = self._register_format(generated_code, search_pool_key, format_pool_key)
+
+        return (new_formats.get('PROMPT_RENDERER'), new_formats.get('QUERY_FORMAT'))
+
+    def _register_format(self, generated_code: Tuple, search_pool_key: str, format_pool_key: str) -> Optional[Tuple[Callable, Callable]]:
+        """Execute the generated renderer and extractor code, and add them to the search pool."""
+        name, description, render_code, extractor_code = generated_code
+
+        try:
+            renderer_func, extractor_func = generated_formats.register(name, render_code, extractor_code)
+        except Exception as e:
+            self.logger.error(f"Error executing generated code: {e}")
             return None
 
-        generated_prompt_renderer = generate_format(
-            self._generate_prompt_renderer,
-            self._generate_prompt_renderer_code,
-            'prompt',
-            'PROMPT_RENDERER',
-            temperature=1
-        )
-
-        generated_query_format = generate_format(
-            self._generate_query_format,
-            self._generate_query_format_code,
-            'query',
-            'QUERY_FORMAT',
-            temperature=1
-        )
-
-        return (generated_prompt_renderer, generated_query_format)
+        self.search_pool[search_pool_key].append((renderer_func, extractor_func))
+        self.search_pool[f"{search_pool_key}_desc"][renderer_func] = description
+        self.format_pool[format_pool_key][renderer_func] = {'confidence_score': 0, 'chosen_count': 0, 'uct_score': 0}
+        return (renderer_func, extractor_func)
 
     def format_select(self, num_prompt: int, round: int) -> Tuple[List, List]:
         """Apply knowledge-based formats."""
@@ -204,16 +346,16 @@ class FormatMutator(BaseMutator):
             new_query_formats = [(k, v) for (k, v) in self.search_pool['query'] if k in new_query_formats]
 
         elif self.select_method == "Random":
-            new_prompt_renderers = random.sample(self.search_pool['prompt'], num_prompt)
-            new_query_formats = random.sample(self.search_pool['query'], num_prompt)
+            new_prompt_renderers = self.rng.sample(self.search_pool['prompt'], num_prompt)
+            new_query_formats = self.rng.sample(self.search_pool['query'], num_prompt)
         else:
             raise NotImplementedError
 
         self.logger.info(f"Selected formats:\nPrompt renderers: {new_prompt_renderers}\nQuery formats: {new_query_formats}")
         return (new_prompt_renderers, new_query_formats)
 
-    def _generate_prompt_renderer(self) -> Optional[Tuple]:
-        """Generate a new PROMPT_RENDERER."""
+    def _get_prompt_renderer_prompt(self) -> List[Dict[str, str]]:
+        """Build the meta prompt requesting a new PROMPT_RENDERER."""
         format_fn_desc = []
         for key, content in self.search_pool['prompt_desc'].items():
             format_fn_desc.append((key.__name__[:-9], content))
@@ -225,66 +367,13 @@ class FormatMutator(BaseMutator):
         else:
             task_specific_instruction = "Ensure the format is clear, structured, and aligned with commonly used prompt formats."
 
-        prompt_to_generate_format = f"""{self._get_meta_prompt_header()}
-
-        The whole prompt is  \"\"\"{str(self.prompt_history.beam_history[self.round-1][0]).strip()}\"\"\"
-
-        We have some preset PROMPT_RENDERER candidates, here are our whole search pool:
-        {format_fn_desc_string}
-        
-        Here are two examples from our PROMPT_RENDERER candidates as for your reference:
-        <Format name: markdown>
-        ##### Task Instruction
-        {{TASK_INSTRUCTION}}
-        
-        ##### Task Detail
-        {{TASK_DETAIL}}
-
-        ##### Output Format
-        {{OUTPUT_FORMAT}}
-
-        ##### Examples
-        {{EXAMPLES}}
-
-        <Format name: xml>
-        <TaskInstruction>{{TASK_INSTRUCTION}}</TaskInstruction>
-        <TaskDetail>{{TASK_DETAIL}}</TaskDetail>
-        <OutputFormat>{{OUTPUT_FORMAT}}</OutputFormat>
-        <Examples>{{EXAMPLES}}</Examples>
-
-        Please generate ONE new format for the PROMPT_RENDERER segment, its description and render the {{TASK_INSTRUCTION}}, {{TASK_DETAIL}}, {{OUTPUT_FORMAT}} and {{EXAMPLES}} segments using this new format. The new format could either be distinct from the existing formats, or a variation of an existing format. 
-        
-        If you choose a completely new format, ensure that the new format is conventional, structured, and aligned with commonly used prompt formats. Avoid overly creative or unconventional formats that deviate significantly from standard practices. 
-
-        If it's a variation of an existing format, the variation can change the order of the segments, or drop some segments.
-
-        {task_specific_instruction}
-
-        The format name should only include alphanumeric characters and underscores. Special characters such as `|`, `!`, `#`, `@`, and spaces should be avoided. 
-        
-        Please encapsulate the new prompt format using the following format:
-        
-        <START>
-        <Format name: [format name]>
-        <Description: [format description]>
-        [The rendered segments rendered by the newly generated format]
-        <END>
-        """
-
-        prompt_to_generate_format = '\n'.join([line.lstrip() for line in prompt_to_generate_format.split('\n')])
-        response = self.mutation_llm.inference(prompt_to_generate_format, desc="generate prompt format", temperature=1)
-        # self.logger.info(f"\n### Prompt to generate prompt renderer: {prompt_to_generate_format}")
-
-        new_formats = self._parse_format(parse_tagged_text(response, "<START>", "<END>"))
+        instruction = PROMPT_RENDERER_TEMPLATE.format(format_fn_desc_string=format_fn_desc_string, task_specific_instruction=task_specific_instruction)
+        return self._get_meta_messages(instruction, self.prompt_history.beam_history[self.round-1][0])
 
-        if len(new_formats) == 0:
-            return None
-        return new_formats[0]
-
-    def _generate_prompt_renderer_code(self, new_format, search_pool, format_desc, temperature):
+    def _get_prompt_renderer_code_prompt(self, new_format, search_pool, format_desc):
         """
         new_format: (format_name, format_description, rendered_example)
-        return: (name, description, render_new_code, extractor_new_code)
+        return: the meta prompt requesting (name, description, render_new_code, extractor_new_code)
         """
         (format_name, format_description, rendered_example) = new_format
 
@@ -293,53 +382,22 @@ class FormatMutator(BaseMutator):
             format_fn_desc.append((key.__name__[:-9], content))
         format_fn_desc_string = "\n".join([f"{name}: {desc}" for name,desc in format_fn_desc])
 
-        prompt_to_generate_code = f"""{self._get_meta_prompt_header()}
-
-        We have some preset PROMPT_RENDERER candidates, here are our whole search pool:
-        {format_fn_desc_string}
-
-        Here are two code implementations from our PROMPT_RENDERER candidates as for your reference:
-        <Format name: markdown>
-        <Renderer code>
-        {inspect.getsource(search_pool[1][0])}
-        <Extractor code>
-        {inspect.getsource(search_pool[1][1])}
-
-        <Format name: xml>
-        <Renderer code>
-        {inspect.getsource(search_pool[4][0])}
-        <Extractor code>
-        {inspect.getsource(search_pool[4][1])}
-
-        Here is a example rendered by a new format:
-        {rendered_example}
-
-        Please generate the code for this provided example based on the new PROMPT_RENDERER. Ensure that both the renderer and extractor functions are included. The generated code should be plain Python code without any Markdown syntax or language identifiers such as ```python or '''python. Please output the code directly without any additional formatting. Note that the name of the functions must be completely SAME with the name of format, i.e. [Format name]_renderer and [Format_name]_extractor.
-        Please encapsulate the using the following format:
-        
-        <START>
-        <Format name: {format_name}>
-        <Description: {format_description}>
-        <Renderer code>
-        [Renderer code]
-        <Extractor code>
-        [Extractor code]
-        <END>
-        """
-
-        prompt_to_generate_code = '\n'.join([line.lstrip() for line in prompt_to_generate_code.split('\n')])
-        response = self.mutation_llm.inference(prompt_to_generate_code, desc="generate prompt format code", temperature=temperature)
-        # self.logger.info(f"\n### Prompt to generate prompt renderer code: {prompt_to_generate_code}")
-
-        new_formats = self._parse_format_code(parse_tagged_text(response, "<START>", "<END>"))
-        if len(new_formats) == 0:
-            return None
-        return new_formats[0]    
+        instruction = PROMPT_RENDERER_CODE_TEMPLATE.format(
+            format_fn_desc_string=format_fn_desc_string,
+            renderer_code_1=inspect.getsource(search_pool[1][0]).strip(),
+            extractor_code_1=inspect.getsource(search_pool[1][1]).strip(),
+            renderer_code_2=inspect.getsource(search_pool[4][0]).strip(),
+            extractor_code_2=inspect.getsource(search_pool[4][1]).strip(),
+            rendered_example=rendered_example,
+            format_name=format_name,
+            format_description=format_description,
+        )
+        return self._get_meta_messages(instruction)
 
-    def _generate_query_format_code(self, new_format, search_pool, format_desc, temperature):
+    def _get_query_format_code_prompt(self, new_format, search_pool, format_desc):
         """
         new_format: (format_name, format_description, rendered_example)
-        return: (name, description, render_new_code, extractor_new_code)
+        return: the meta prompt requesting (name, description, render_new_code, extractor_new_code)
         """
         (format_name, format_description, rendered_example) = new_format
 
@@ -372,53 +430,22 @@ class FormatMutator(BaseMutator):
             rendered_example_1 = self.search_pool['query'][0][0](example["question"], example['choices'], example["answer"], self.prompt_history.beam_history[self.round-1][0].cot_hinter).strip()
             rendered_example_2 = self.search_pool['query'][1][0](example["question"], example['choices'], example["answer"], self.prompt_history.beam_history[self.round-1][0].cot_hinter).strip()
 
-        prompt_to_generate_code = f"""{self._get_meta_prompt_header()}
-
-        We have some preset QUERY_FORMAT candidates, here are our whole search pool:
-        {format_fn_desc_string}
-
-        Here are two code implementations from our QUERY_FORMAT candidates as for your reference:
-        <Format name: {format_name_exs[0]}>
-        <Renderer code>
-        {inspect.getsource(search_pool[0][0])}
-        <Extractor code>
-        {inspect.getsource(search_pool[0][1])}
-
-        <Format name: {format_name_exs[1]}>
-        <Renderer code>
-        {inspect.getsource(search_pool[3][0])}
-        <Extractor code>
-        {inspect.getsource(search_pool[3][1])}
-
-        Here is the example rendered by the new format:
-        {rendered_example}
-
-        Please generate the code for this provided example based on the new QUERY_FORMAT. Ensure that both the renderer and extractor functions are included. The generated code should be plain Python code without any Markdown syntax or language identifiers such as ```python or '''python. Please output the code directly without any additional formatting.
-
-        Please encapsulate the using the following format:
-        
-        <START>
-        <Format name: {format_name}>
-        <Description: {format_description}>
-        <Renderer code>
-        [Renderer code]
-        <Extractor code>
-        [Extractor code]
-        <END>
-        """
-
-        prompt_to_generate_code = '\n'.join([line.lstrip() for line in prompt_to_generate_code.split('\n')])
-        response = self.mutation_llm.inference(prompt_to_generate_code, desc="generate query format code", temperature=temperature)
-
-        new_formats = self._parse_format_code(parse_tagged_text(response, "<START>", "<END>"))
-        # self.logger.info(f"\n### Prompt to generate query format code: {prompt_to_generate_code}")
-
-        if len(new_formats) == 0:
-            return None
-        return new_formats[0]
+        instruction = QUERY_FORMAT_CODE_TEMPLATE.format(
+            format_fn_desc_string=format_fn_desc_string,
+            format_name_1=format_name_exs[0],
+            renderer_code_1=inspect.getsource(search_pool[0][0]).strip(),
+            extractor_code_1=inspect.getsource(search_pool[0][1]).strip(),
+            format_name_2=format_name_exs[1],
+            renderer_code_2=inspect.getsource(search_pool[3][0]).strip(),
+            extractor_code_2=inspect.getsource(search_pool[3][1]).strip(),
+            rendered_example=rendered_example,
+            format_name=format_name,
+            format_description=format_description,
+        )
+        return self._get_meta_messages(instruction)
 
-    def _generate_query_format(self) -> Optional[Tuple]:
-        """Generate a new QUERY_FORMAT."""
+    def _get_query_format_prompt(self) -> List[Dict[str, str]]:
+        """Build the meta prompt requesting a new QUERY_FORMAT."""
         if self.task.__class__.__name__ in ['GSM8KTask', 'MATHTask']:
             example = {
                 "question": "There are 15 trees in the grove. Grove workers will plant trees in the grove today. After they are done, there will be 21 trees. How many trees did the grove workers plant today?",
@@ -448,57 +475,19 @@ class FormatMutator(BaseMutator):
             format_fn_desc.append((key.__name__[:-9], content))
         format_fn_desc_string = "\n".join([f"{name}: {desc}" for name, desc in format_fn_desc])
 
-        prompt_to_generate_format = f"""{self._get_meta_prompt_header()}
-
-        The whole prompt is  \"\"\"{str(self.prompt_history.beam_history[self.round-1][0]).strip()}\"\"\"
-
-        We have some preset QUERY_FORMAT candidates, here are our whole search pool:
-        {format_fn_desc_string}
-        
-        Here are two examples from our QUERY_FORMAT candidates as for your reference:
-        <Format name: {format_name[0]}>
-        {rendered_example_1}
-
-        <Format name: {format_name[1]}>
-        {rendered_example_2}
-
-        Please generate ONE new format for the QUERY_FORMAT segment, its description and render the provided example using this new format. The new format could either be a completely new format or a variation of an existing format. 
-        
-        If you choose to generate a completely new format, please ensure that the new format is conventional, structured, and aligned with commonly used query formats. Avoid overly creative or unconventional formats that deviate significantly from standard practices. The new format should be distinct from the existing formats. 
-
-        The variation can focus on two parts, CASING and SEPARATOR:
-
-        CASING refers to both the capitalization of the text (e.g., f(x) = x.title(), f(x) = x.upper(), f(x) = x.lower()) and the specific wording or phrasing used (e.g., changing "question" to "instruction" or "input"). 
-
-        SEPARATOR: the punctuation or symbols used to separate the question and answer, there are some candidates as for your reference {{'', ' ', '\\n', '--', ';\\n', ' ||', '<sep>', ' \\n', ':', '.'}}.
-        
-        {task_specific_instruction}
-
-        The format name should only include alphanumeric characters and underscores. Special characters such as `|`, `!`, `#`, `@`, and spaces should be avoided.
-        
-        Please encapsulate the new query format using the following format:
-        
-        <START>
-        <Format name: [format name]>
-        <Description: [format description]>
-        [The example rendered by the newly generated format]
-        <END>
-        """
-
-        prompt_to_generate_format = '\n'.join([line.lstrip() for line in prompt_to_generate_format.split('\n')])
-        response = self.mutation_llm.inference(prompt_to_generate_format, desc="generate query format", temperature=1)
-        # self.logger.info(f"\n### Prompt to generate query format: {prompt_to_generate_format}")
-
-        new_formats = self._parse_format(parse_tagged_text(response, "<START>", "<END>"))
-
-        if len(new_formats) == 0:
-            return None
-        return new_formats[0]
+        instruction = QUERY_FORMAT_TEMPLATE.format(
+            format_fn_desc_string=format_fn_desc_string,
+            format_name_1=format_name[0],
+            rendered_example_1=rendered_example_1,
+            format_name_2=format_name[1],
+            rendered_example_2=rendered_example_2,
+            task_specific_instruction=task_specific_instruction,
+        )
+        return self._get_meta_messages(instruction, self.prompt_history.beam_history[self.round-1][0])
 
     def _get_meta_prompt_header(self) -> str:
         """Get the meta prompt header for format generation."""
-        return f"""I'm trying to write a prompt to {self.task.task_intention}.
-        The ultimate aim is to create a prompt that is clear, structured, and efficient, leading to accurate responses from the AI model. The structure of the prompt includes several essential elements: {self.component_desc}""".strip()
+        return FORMAT_META_PROMPT_HEADER_TEMPLATE.format(task_intention=self.task.task_intention, component_desc=self.component_desc)
 
     def _update_format_pool(self, node_list: List, component: str, round: int):
         """Update the knowledge pool for formats."""
@@ -526,6 +515,14 @@ class FormatMutator(BaseMutator):
                 ), format, round
             )
 
+    def _parse_new_format(self, response: str) -> Optional[Tuple]:
+        new_formats = self._parse_format(parse_tagged_text(response, "<START>", "<END>"))
+        return new_formats[0] if new_formats else None
+
+    def _parse_new_format_code(self, response: str) -> Optional[Tuple]:
+        new_formats = self._parse_format_code(parse_tagged_text(response, "<START>", "<END>"))
+        return new_formats[0] if new_formats else None
+
     def _parse_format(self, texts, format_name_pattern=r"<Format name: (?:\d+\.)?\s*(.*?)>\n<Description: (.*?)>\n(.+)"):
         """ Parse text that is tagged with start and end tags."""
         outputs = []
@@ -0,0 +1,89 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Renderer and extractor functions written by the FormatMutator during a run.
+
+Generated code is executed into this module under a name unique to the run, so that prompts using a
+generated format pickle by reference, like prompts using a format of the search pool. Pickles that
+reference generated formats start with a snapshot of their source, which re-executes the code on load,
+before the prompts that use the functions are loaded.
+"""
+
+import re
+import json
+import math
+import random
+import string
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Unique format name -> (format name in the generated code, renderer code, extractor code)
+_sources: Dict[str, Tuple[str, str, str]] = {}
+_lock = threading.Lock()
+
+# Names the generated code may use without importing them, as it did when it was executed in the format mutator
+_SCOPE = {'re': re, 'json': json, 'math': math, 'random': random, 'string': string, 'Any': Any, 'Dict': Dict, 'List': List, 'Optional': Optional, 'Tuple': Tuple}
+
+
+def _load(unique_name: str, name: str, render_code: str, extractor_code: str) -> Tuple[Callable, Callable]:
+    scope = {'__name__': __name__, **_SCOPE}
+    exec(render_code, scope)
+    exec(extractor_code, scope)
+    functions = (scope[f"{name}_renderer"], scope[f"{name}_extractor"])
+    if not all(callable(fn) for fn in functions):
+        raise TypeError(f"Generated {name}_renderer and {name}_extractor must be functions")
+
+    for fn, suffix in zip(functions, ('renderer', 'extractor')):
+        fn.__name__ = fn.__qualname__ = f"{unique_name}_{suffix}"
+        globals()[fn.__name__] = fn
+    _sources[unique_name] = (name, render_code, extractor_code)
+    return functions
+
+
+def register(name: str, render_code: str, extractor_code: str) -> Tuple[Callable, Callable]:
+    """
+    Execute the code of a generated format, which defines `{name}_renderer` and `{name}_extractor`.
+
+    Returns:
+        Tuple[Callable, Callable]: The renderer and extractor, renamed after a unique format name
+        (name, then name_2, name_3, ...) so that formats generated with the same name in different rounds stay distinct.
+    """
+    with _lock:
+        unique_name, i = name, 1
+        while unique_name in _sources:
+            i += 1
+            unique_name = f"{name}_{i}"
+        return _load(unique_name, name, render_code, extractor_code)
+
+
+def restore(sources: Dict[str, Tuple[str, str, str]]) -> None:
+    """Re-execute the generated formats of a snapshot that are not registered in this process yet."""
+    with _lock:
+        for unique_name, (name, render_code, extractor_code) in sources.items():
+            if unique_name in _sources:
+                if _sources[unique_name] != (name, render_code, extractor_code):
+                    raise ValueError(f"Generated format {unique_name} is already registered with different code")
+                continue
+            _load(unique_name, name, render_code, extractor_code)
+
+
+class GeneratedFormats:
+    """Source of the generated formats at one point of the run. Unpickling it registers the formats again."""
+
+    def __init__(self, sources: Dict[str, Tuple[str, str, str]]):
+        self.sources = sources
+
+    def __reduce__(self):
+        return (_restored, (self.sources,))
+
+
+def _restored(sources: Dict[str, Tuple[str, str, str]]) -> GeneratedFormats:
+    restore(sources)
+    return GeneratedFormats(sources)
+
+
+def snapshot() -> GeneratedFormats:
+    """Source of every format generated so far. Pickle it before the objects referencing the formats."""
+    with _lock:
+        return GeneratedFormats(dict(_sources))
@@ -1,12 +1,30 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
-from .base import BaseMutator
-import random
+from .base import BaseMutator, compile_template
 import re
-from typing import List, Tuple, Optional
+from collections import Counter
+from typing import Dict, List, Tuple, Optional
 from utils import parse_tagged_text
 
+SYNONYMS_FOR_EXAMPLES_TEMPLATE = compile_template('''
+    The existing EXAMPLE set contains:
+    """{examples}"""
+
+    Please generate a variation of the EXAMPLES set within the prompt while keeping the semantic meaning. The revision should represent ONLY ONE of the following specific actions:
+    1. Addition: Incorporating one new example into the existing set.
+    2. Deletion: Eliminating one single example from the current set.
+    3. Modification: Changing the content of an example while maintaining its contextual relevance.
+    Please present the results without indicating which action was taken. The varied EXAMPLES segment is as follows:
+''')
+
+SYNONYMS_TEMPLATE = compile_template('''
+    Please create a different version of {component_name} segment without changing its semantic meaning. In case this segment is an empty string, generate a suitable one. The existing {component_name} segment contains:
+    """{component}"""
+
+    The varied {component_name} segment is as follows:
+''')
+
 class MonteCarloSampling(BaseMutator):
     def __init__(
         self,
@@ -25,25 +43,41 @@ class MonteCarloSampling(BaseMutator):
 
     def random_choose_component(self, n: int = 1) -> List[str]:
         """Randomly choose components to mutate."""
-        return random.sample(self.COMPONENT_KEYS, random.randint(1, min(len(self.COMPONENT_KEYS), n)))
+        return self.rng.sample(self.COMPONENT_KEYS, self.rng.randint(1, min(len(self.COMPONENT_KEYS), n)))
 
     def generate_synonyms(self, prompt, num_prompt: int = 3, num_component: int = 1, round: int = -1, temperature: float = 1) -> List:
         """Generate synonyms for a prompt by mutating selected components."""
         new_prompts = []
 
-        for _ in range(num_prompt):
-            selected_component_keys = self.random_choose_component(num_component)
+        # Variations of the same component share one multi-completion request
+        selected_component_keys_list = [self.random_choose_component(num_component) for _ in range(num_prompt)]
+        num_variations = Counter(component_key for selected_component_keys in selected_component_keys_list for component_key in selected_component_keys)
+        component_keys = list(num_variations)
+        responses = self.mutation_llm.inference_many_n(
+            [self._get_synonyms_prompt(prompt, component_key) for component_key in component_keys],
+            temperature=temperature,
+            ns=[num_variations[component_key] for component_key in component_keys],
+            desc="get variation",
+        )
+        variations = {component_key: iter(response) for component_key, response in zip(component_keys, responses)}
+
+        for selected_component_keys in selected_component_keys_list:
             component_key_list, content_list = [], []
 
             for component_key in selected_component_keys:
-                if component_key == "EXAMPLES":
-                    content = self._generate_synonyms_for_examples(prompt, temperature=temperature)
-                else:
-                    content = self._generate_synonyms(prompt, component_key, temperature=temperature)
+                # The API may return fewer completions than requested; the component is then left unchanged
+                response = next(variations[component_key], None)
+                if response is None:
+                    continue
+                content = self._parse_synonyms(prompt, component_key, response)
 
                 component_key_list.append(component_key)
                 content_list.append(content)
 
+            if not component_key_list:
+                self.logger.warning(f"No variation returned for component keys {selected_component_keys}, skipping the candidate")
+                continue
+
             new_prompt = prompt.generate(
                 round=round,
                 component_keys=component_key_list,
@@ -52,7 +86,7 @@ class MonteCarloSampling(BaseMutator):
             )
 
             try:
-                if str(new_prompt) and str(new_prompt) != str(prompt):
+                if str(new_prompt) and new_prompt.content_hash() != prompt.content_hash():
                     new_prompts.append(new_prompt)
             except Exception as e:
                 self.logger.error(f"Error generating prompt with component keys {component_key_list}: {e}")
@@ -68,38 +102,21 @@ class MonteCarloSampling(BaseMutator):
 
         return new_prompts
 
-    def _generate_synonyms(self, prompt, component_name: str, temperature: float) -> str:
-        """Generate synonyms for a specific component of the prompt."""
-        prompt_to_generate_synonyms = f"""{self._get_meta_prompt_header(prompt)}
-
-        Please create a different version of {component_name} segment without changing its semantic meaning. In case this segment is an empty string, generate a suitable one. The existing {component_name} segment contains:
-        \"\"\"{getattr(prompt, component_name.lower())}\"\"\"
+    def _get_synonyms_prompt(self, prompt, component_name: str) -> List[Dict[str, str]]:
+        """Build the meta prompt requesting a variation of a component of the prompt."""
+        if component_name == "EXAMPLES":
+            instruction = SYNONYMS_FOR_EXAMPLES_TEMPLATE.format(examples=prompt.render_examples(prompt.examples))
+        else:
+            instruction = SYNONYMS_TEMPLATE.format(component_name=component_name, component=getattr(prompt, component_name.lower()))
+        return self._get_meta_messages(instruction, prompt)
 
-        The varied {component_name} segment is as follows:
-        """
-        prompt_to_generate_synonyms = '\n'.join([line.lstrip() for line in prompt_to_generate_synonyms.split('\n')])
-        new_prompt_component = self.mutation_llm.inference(prompt_to_generate_synonyms, desc=f"get variation for {component_name}", temperature=temperature)
+    def _parse_synonyms(self, prompt, component_name: str, new_prompt_component: str) -> str:
+        """Parse the variation of a component returned by the mutation LLM."""
         new_prompt_component = re.sub(r'^[\n"\' ]+|[\n"\' ]+$', '', new_prompt_component)
+        if component_name == "EXAMPLES":
+            return prompt.query_format[1](new_prompt_component, prompt.cot_hinter)
         return prompt.prompt_renderer[1](new_prompt_component)
 
-    def _generate_synonyms_for_examples(self, prompt, temperature: float) -> str:
-        """Generate synonyms for the EXAMPLES section of the prompt."""
-        prompt_to_generate_synonyms = f"""{self._get_meta_prompt_header(prompt)}
-
-        The existing EXAMPLE set contains:
-        \"\"\"{prompt.render_examples(prompt.examples)}\"\"\"
-
-        Please generate a variation of the EXAMPLES set within the prompt while keeping the semantic meaning. The revision should represent ONLY ONE of the following specific actions:
-        1. Addition: Incorporating one new example into the existing set.
-        2. Deletion: Eliminating one single example from the current set.
-        3. Modification: Changing the content of an example while maintaining its contextual relevance.
-        Please present the results without indicating which action was taken. The varied EXAMPLES segment is as follows:
-        """
-        prompt_to_generate_synonyms = '\n'.join([line.lstrip() for line in prompt_to_generate_synonyms.split('\n')])
-        new_prompt_component = self.mutation_llm.inference(prompt_to_generate_synonyms, desc="get variation for example", temperature=temperature)
-        new_prompt_component = re.sub(r'^[\n"\' ]+|[\n"\' ]+$', '', new_prompt_component)
-        return prompt.query_format[1](new_prompt_component, prompt.cot_hinter)
-
     def _parse_format(self, texts: List[str], format_name_pattern: str = r"<Format name: (?:\d+\.)?\s*(.*?)>\n<Description: (.*?)>\n(.+)") -> List[Tuple[str, str, str]]:
         """Parse text that is tagged with start and end tags."""
         outputs = []
@@ -2,9 +2,21 @@
 # Licensed under the MIT license.
 
 from utils import convert_seconds, stringify_dict
+from score_matrix import ScoreMatrix
+from scoring_pipeline import ScoringPipeline
+from usage import usage_tracker, usage_context, format_usage, bind_context
+from mutators.base import seeded_rng
+from mutators import generated_formats
+from checkpoint import save_checkpoint
 import wandb
+import os
 import time
-from typing import List, Dict, Tuple, Optional
+import math
+import itertools
+import random
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Dict, Tuple, Optional
 from copy import deepcopy
 
 class Optimizer:
@@ -25,6 +37,17 @@ class Optimizer:
         prompt_history=None,
         logger=None,
         project_name=None,
+        score_method: str = 'full',
+        race_slice_size: int = 10,
+        race_z: float = 1.96,
+        test_eval: str = 'every_round',
+        screen_llm=None,
+        screen_size: int = -1,
+        screen_ratio: float = 1.0,
+        opt_token_budget: Optional[int] = None,
+        expand_workers: int = 4,
+        pipeline: bool = False,
+        scheduler=None,
     ):
         self.opt_controller = self._init_controller(opt_controller)
         self.case_diagnosis, self.monte_carlo_sampling, self.format_mutator = mutator_list
@@ -42,6 +65,52 @@ class Optimizer:
         self.logger = logger
         self.COMPONENT_KEYS = COMPONENT_KEYS
         self.project_name = project_name
+        if score_method not in ('full', 'racing'):
+            raise ValueError(f"Unknown score method: {score_method}, expected 'full' or 'racing'")
+        self.score_method = score_method
+        self.race_slice_size = race_slice_size
+        self.race_z = race_z
+
+        # Per-example outcomes of every evaluated prompt, indexed by (prompt content hash, example index)
+        self.valid_scores = ScoreMatrix(len(task.valid_set))
+        self.test_scores = ScoreMatrix(len(task.test_set))
+
+        # Fully scored prompts by content hash, so that candidates rendering to an already scored prompt are not evaluated again
+        self.scored_prompts: Dict[str, object] = {}
+
+        # Test-set scoring runs on a background worker, deduplicated by prompt content hash
+        self.test_eval = test_eval
+        self.test_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='test-eval')
+        self._test_score_futures: Dict[str, Future] = {}
+        self._test_log_futures: List[Future] = []
+
+        # Optional low-fidelity screening: a cheaper model and/or a slice of the valid set
+        self.screen_llm = screen_llm
+        self.screen_size = screen_size
+        self.screen_ratio = screen_ratio
+        self.screen_pairs = 0
+        self.screen_discordant_pairs = 0
+
+        # Token usage of every model call, tagged with the round, phase and mutator that made it
+        self.usage_tracker = usage_tracker
+        self.opt_token_budget = opt_token_budget
+
+        # Beam members are expanded concurrently, each with its own seeded RNG
+        self.expand_workers = expand_workers
+
+        # Pipelined rounds score candidates while the rest of the beam is still being expanded; racing
+        # and screening rank candidates against each other, so they need the whole round at once
+        self.pipeline = pipeline and score_method == 'full' and screen_ratio >= 1
+        if pipeline and not self.pipeline:
+            self.logger.warning("Pipelined rounds require --score_method full without screening, scoring after expansion instead")
+
+        # With a budget scheduler, rounds continue until the budget is spent, each with the candidate counts and
+        # screening the scheduler plans, at most those configured above
+        self.scheduler = scheduler
+        self.round_plan = None
+        self.base_num_prompts_per_round = dict(num_prompts_per_round)
+        self.base_screen_ratio = screen_ratio
+        self.base_screen_size = screen_size
 
     def _init_controller(self, opt_controller: Optional[str]) -> "Controller":
         class Controller:
@@ -57,7 +126,19 @@ class Optimizer:
         prompts = [init_prompt] if not isinstance(init_prompt, list) else init_prompt
         start_time = time.time()
 
-        for round in range(self.cur_round, self.total_round + 1):
+        rounds = itertools.count(self.cur_round) if self.scheduler else range(self.cur_round, self.total_round + 1)
+        if self.scheduler:
+            self.scheduler.start()
+
+        for round in rounds:
+            if round > 0 and self._opt_budget_exhausted():
+                self.logger.info(f"\nOptimizer LLM token budget of {self.opt_token_budget} exhausted, stop expanding before round {round}\n")
+                break
+            if round > 0 and self.scheduler:
+                stop_reason = self.scheduler.stop_reason()
+                if stop_reason:
+                    self.logger.info(f"\nBudget scheduler stops before round {round}: {stop_reason}\n")
+                    break
             self.round = round
             round_start_time = time.time()
             self._log_round_start(round, prompts)
@@ -67,15 +148,27 @@ class Optimizer:
             # prompts = self.format_mutator(prompts, self.num_prompts_per_round['format'], self.round)
             # break
             # ### Test format mutator
-            
-            if round == 0:
-                self._evaluate_initial_round(prompts)
-            else:
-                prompts = self._process_round(prompts)
 
-            self._evaluate_test_set(prompts, round)
+            with usage_context(round=round):
+                if round == 0:
+                    self._evaluate_initial_round(prompts)
+                elif self.scheduler:
+                    self._plan_round(prompts)
+                    prompts = self._process_round(prompts)
+                    self.scheduler.end_round(prompts[0].eval_score)
+                else:
+                    prompts = self._process_round(prompts)
+
+                if self.test_eval == 'every_round':
+                    self._evaluate_test_set(prompts, round)
             self._log_round_end(round, round_start_time)
+            self._save_checkpoint(prompts)
+
+        if self.test_eval == 'final':
+            self._evaluate_test_set(prompts, self.round)
+        self._wait_test_set()
 
+        self._log_final_usage()
         self._log_final_time(start_time)
         return prompts[:self.num_prompt_return]
 
@@ -86,13 +179,37 @@ class Optimizer:
     def _evaluate_initial_round(self, prompts: List):
         """Evaluate the initial round."""
         self.logger.info(f"\n================ In Round {self.round}. Start Evaluation on valid set ================")
-        score, _, _, _, _ = self.task.run_evaluate(self.eval_llm, prompts[0], self.task.valid_set, desc='Run evaluate on valid set')
+        with usage_context(phase='score'):
+            self._score_full([prompts[0]])
         self.prompt_history.beam_history[self.round] = [prompts[0]]
 
+    def _round_kind(self) -> str:
+        """Format rounds alternate with feedback and random rounds when the format mutator is enabled."""
+        if self.base_num_prompts_per_round['format'] > 0 and self.format_mutator and self.round % 2 == 0:
+            return 'format'
+        return 'diagnosis_variation'
+
+    def _plan_round(self, prompts: List):
+        """Set the candidate counts and the screening of the round from the budget scheduler."""
+        self.round_plan = self.scheduler.plan(
+            self._round_kind(), self.base_num_prompts_per_round, self.base_screen_ratio, prompts[0].eval_score, allow_screening=not self.pipeline
+        )
+        self.num_prompts_per_round = self.round_plan.num_prompts_per_round
+        self.screen_ratio = self.round_plan.screen_ratio
+        # Screening on the whole valid set saves nothing, so a scheduled screen uses the same fraction of it
+        if self.base_screen_size == -1 and self.screen_ratio < 1:
+            self.screen_size = max(1, math.ceil(self.screen_ratio * len(self.task.valid_set)))
+        else:
+            self.screen_size = self.base_screen_size
+        self.logger.info(
+            f"Round {self.round} budget plan: {self.round_plan.progress:.1%} of the budget spent, round scaled by {self.round_plan.scale:.2f}, "
+            f"candidates per mutator {self.num_prompts_per_round}, screen ratio {self.screen_ratio:.2f} on {self.screen_size} valid examples"
+        )
+
     def _process_round(self, prompts: List):
         """Process a round of optimization."""
         if self.num_prompts_per_round['format'] > 0 and self.format_mutator:
-            if self.round % 2 == 1:
+            if self._round_kind() == 'diagnosis_variation':
                 prompts = self._expand_and_score_diagnosis_variation(prompts)
             else:
                 prompts = self._expand_and_score_format(prompts)
@@ -107,12 +224,22 @@ class Optimizer:
         """Expand and score prompts using feedback and random mutators."""
         start_time = time.time()
         self.logger.info(f"\n================ In Round {self.round}. Start Expand Candidates by Feedback Mutator and Random Mutators================")
-        prompts, minibatch = self.expand_candidates_diagnosis_variation(prompts)
-        self.logger.info(f'\n ROUND {self.round} FEEDBACK AND RANDOM EXPAND TIME: {convert_seconds((time.time() - start_time))}\n')
+        scorer = ScoringPipeline(self._score_pipelined) if self.pipeline else None
+        try:
+            with usage_context(phase='expand'):
+                prompts, minibatch = self.expand_candidates_diagnosis_variation(prompts, on_candidates=scorer.submit if scorer else None)
+            self.logger.info(f'\n ROUND {self.round} FEEDBACK AND RANDOM EXPAND TIME: {convert_seconds((time.time() - start_time))}\n')
+        finally:
+            # The scoring thread is stopped even when the expansion fails
+            if scorer:
+                start_time = time.time()
+                scorer.close()
+                self.logger.info(f'\n ROUND {self.round} PIPELINED SCORE WAIT TIME: {convert_seconds((time.time() - start_time))}, {scorer.num_batches} scoring batches\n')
 
         self.logger.info(f"\n================ In Round {self.round}. Start Score {len(prompts)} Candidates and Beam Search ================")
         start_time = time.time()
-        prompts, _ = self.score_candidates(prompts)
+        with usage_context(phase='score'):
+            prompts, _ = self.score_candidates(prompts)
         self.logger.info(f'\n ROUND {self.round} SCORE TIME: {convert_seconds((time.time() - start_time))}\n')
         return prompts
 
@@ -120,12 +247,14 @@ class Optimizer:
         """Expand and score prompts using format mutator."""
         self.logger.info(f"\n================ In Round {self.round}. Start Expand Candidates by Format Mutator================")
         start_time = time.time()
-        prompts = self.expand_candidates_format(prompts)
+        with usage_context(phase='expand'):
+            prompts = self.expand_candidates_format(prompts)
         self.logger.info(f'\n ROUND {self.round} FORMAT EXPAND TIME: {convert_seconds((time.time() - start_time))}\n')
 
         self.logger.info(f"\n================ In Round {self.round}. Start Score {len(prompts)} Candidates and Beam Search ================")
         start_time = time.time()
-        prompts, _ = self.score_candidates(prompts)
+        with usage_context(phase='score'):
+            prompts, _ = self.score_candidates(prompts)
         self.logger.info(f'\n ROUND {self.round} SCORE TIME: {convert_seconds((time.time() - start_time))}\n')
         return prompts
 
@@ -140,30 +269,123 @@ class Optimizer:
         self.logger.info(f"\n================ In Round {self.round}. Start Update Prompt History ================")
         self.prompt_history.beam_history[self.round] = prompts
         self.prompt_history.round = self.round
-        self.prompt_history.save(path=self.project_name)
+        self.prompt_history.save(path='prompt_history')
+        self._save_score_matrices()
+
+    def _save_score_matrices(self):
+        """Persist the per-example score matrices with the run."""
+        if self.output_path:
+            self.valid_scores.save(os.path.join(self.output_path, 'valid_scores.npz'))
+            self.test_scores.save(os.path.join(self.output_path, 'test_scores.npz'))
+
+    def _save_checkpoint(self, prompts: List):
+        """Save everything needed to continue the run after this round."""
+        if not self.output_path:
+            return
+        state = {
+            # Pickled first, so that the generated formats exist again before the prompts using them are loaded
+            'generated_formats': generated_formats.snapshot(),
+            'round': self.round,
+            'prompts': prompts,
+            # The split is drawn at random when the task is built, so a resumed run restores it rather than drawing it again
+            'dataset': (self.task.train_set, self.task.valid_set, self.task.test_set),
+            'prompt_history': self.prompt_history,
+            'format_pool': self.format_mutator.format_pool if self.format_mutator else None,
+            'search_pool': self.format_mutator.search_pool if self.format_mutator else None,
+            'scored_prompts': self.scored_prompts,
+            'valid_scores': self.valid_scores,
+            'test_scores': self.test_scores,
+            'usage': self.usage_tracker.state(),
+            'scheduler': self.scheduler.state() if self.scheduler else None,
+            'rng_state': {'random': random.getstate(), 'numpy': np.random.get_state()},
+            'opt_cache': self.case_diagnosis.mutation_llm.cache_state(),
+            'eval_cache': self.eval_llm.cache_state() if self.eval_llm else None,
+        }
+        path = save_checkpoint(self.output_path, self.round, state)
+        self.logger.info(f"Round {self.round} checkpoint saved to {path}")
+
+    def resume(self, checkpoint: Dict) -> List:
+        """
+        Restore the state of a checkpointed run, so that run() continues with the round after the checkpoint.
+
+        Returns:
+            List: The beam of the checkpointed round, to pass to run().
+        """
+        self.round = checkpoint['round']
+        self.cur_round = self.round + 1
+        self.task.set_dataset(checkpoint['dataset'])
+        self.prompt_history = checkpoint['prompt_history']
+        if self.format_mutator:
+            self.format_mutator.prompt_history = self.prompt_history
+            self.format_mutator.format_pool = checkpoint['format_pool']
+            self.format_mutator.search_pool = checkpoint['search_pool']
+        self.scored_prompts = checkpoint.get('scored_prompts', {})
+        self.valid_scores = checkpoint['valid_scores']
+        self.test_scores = checkpoint['test_scores']
+        self.usage_tracker.load_state(checkpoint['usage'])
+        if self.scheduler and checkpoint.get('scheduler'):
+            self.scheduler.load_state(checkpoint['scheduler'])
+        random.setstate(checkpoint['rng_state']['random'])
+        np.random.set_state(checkpoint['rng_state']['numpy'])
+
+        for llm, key in ((self.case_diagnosis.mutation_llm, 'opt_cache'), (self.eval_llm, 'eval_cache')):
+            if llm is None or not checkpoint.get(key):
+                continue
+            if llm.cache_state()['cache_path'] != checkpoint[key]['cache_path']:
+                self.logger.warning(f"Checkpointed run used the {key} {checkpoint[key]['cache_path']}, resuming with {llm.cache_state()['cache_path']}")
+            llm.load_cache_state(checkpoint[key])
+
+        prompts = checkpoint['prompts']
+        self.logger.info(f"Resumed from the round {self.round} checkpoint with {len(prompts)} prompts, continuing with round {self.cur_round}")
+        # Test-set evaluations still running when the checkpoint was saved are queued again
+        if self.test_eval == 'every_round' and any(prompt.test_score is None for prompt in prompts):
+            self._evaluate_test_set(prompts, self.round)
+        return prompts
 
     def _evaluate_test_set(self, prompts: List, round: int):
-        """Evaluate prompts on the test set."""
+        """Queue the evaluation of prompts on the test set to the background worker."""
         self.logger.info(f"\n================ In Round {self.round}. Start Evaluation on test set ================")
-        start_time = time.time()
 
         for rank, prompt in enumerate(prompts):
-            self._log_and_evaluate_prompt(prompt, rank, round)
-
-        self.logger.info(f'\n ROUND {round} EVALUATION TIME: {convert_seconds((time.time() - start_time))}\n')
-
-    def _log_and_evaluate_prompt(self, prompt, rank: int, round: int):
-        """Log and evaluate a single prompt."""
-        self.logger.info(f"\n================ Round {round} Rank {rank} Candidate ================\n\n{prompt}")
-        if prompt.test_score is None:
-            test_score, _, _, _, _ = self.task.run_evaluate(self.eval_llm, prompt, self.task.test_set, desc='Run evaluate on test set')
-            prompt.test_score = test_score
-        else:
-            test_score = prompt.test_score
-
-        self.logger.info(f'Evaluate Score: {prompt.eval_score}, Test Score: {test_score}')
+            self.logger.info(f"\n================ Round {round} Rank {rank} Candidate ================\n\n{prompt}")
+            key = prompt.content_hash()
+            if key not in self._test_score_futures:
+                if prompt.test_score is not None:
+                    future = Future()
+                    future.set_result(prompt.test_score)
+                    self._test_score_futures[key] = future
+                else:
+                    self._test_score_futures[key] = self.test_executor.submit(self._evaluate_test_score, prompt, key, round)
+
+            # The worker is single-threaded, so the log job runs after the evaluation it waits for
+            self._test_log_futures.append(
+                self.test_executor.submit(self._log_test_result, prompt, rank, round, self._test_score_futures[key])
+            )
+
+    def _evaluate_test_score(self, prompt, key: str, round: int) -> float:
+        """Evaluate a single prompt on the test set, yielding the eval LLM to valid-set scoring."""
+        start_time = time.time()
+        with usage_context(round=round, phase='test'):
+            test_score, _, _, _, score_list = self.task.run_evaluate(self.eval_llm, prompt, self.task.test_set, desc='Run evaluate on test set', background=True)
+        self.test_scores.record(key, np.arange(len(score_list)), score_list)
+        self.logger.info(f'\n TEST EVALUATION TIME: {convert_seconds((time.time() - start_time))}\n')
+        return test_score
+
+    def _log_test_result(self, prompt, rank: int, round: int, score_future: Future):
+        """Log the test result of a prompt once its evaluation is done."""
+        prompt.test_score = score_future.result()
+        self.logger.info(f'Round {round} Rank {rank} Evaluate Score: {prompt.eval_score}, Test Score: {prompt.test_score}')
         self._log_to_wandb(prompt, rank, round)
 
+    def _wait_test_set(self):
+        """Wait for the queued test-set evaluations to finish."""
+        start_time = time.time()
+        for future in self._test_log_futures:
+            future.result()
+        self._test_log_futures = []
+        self._save_score_matrices()
+        self.logger.info(f'\n TEST SET WAIT TIME: {convert_seconds((time.time() - start_time))}\n')
+
     def _log_to_wandb(self, prompt, rank: int, round: int):
         """Log prompt details to WandB."""
         wandb_log = {
@@ -192,71 +414,277 @@ class Optimizer:
 
     def _log_round_end(self, round: int, round_start_time: float):
         """Log the end of a round."""
+        for role in ('opt', 'eval'):
+            self.logger.info(f'Round {round} {role} LLM usage: {format_usage(self.usage_tracker.totals(role=role, round=round))}')
+        for mutator, totals in self.usage_tracker.breakdown('mutator', role='opt', round=round).items():
+            if mutator:
+                self.logger.info(f'Round {round} opt LLM usage of {mutator}: {format_usage(totals)}')
         self.logger.info(f'\n ROUND {round} OVERALL TIME: {convert_seconds((time.time() - round_start_time))}\n')
 
+    def _log_final_usage(self):
+        """Log the total usage of the run, which includes test-set evaluations finished after their round ended."""
+        for role in ('opt', 'eval'):
+            self.logger.info(f'\nOVERALL {role.upper()} LLM USAGE: {format_usage(self.usage_tracker.totals(role=role))}')
+
+    def usage_by_round(self, **filters) -> Dict:
+        """Per-round usage totals, e.g. usage_by_round(role='opt') for the optimizer LLM alone."""
+        return {round: totals for round, totals in self.usage_tracker.breakdown('round', **filters).items() if round is not None}
+
+    def _opt_budget_exhausted(self) -> bool:
+        """Whether the optimizer LLM has used up the run's token budget."""
+        return self.opt_token_budget is not None and self.usage_tracker.totals(role='opt')['total_tokens'] >= self.opt_token_budget
+
     def _log_final_time(self, start_time: float):
         """Log the total time taken."""
         self.logger.info(f'\nFINISHED! OVERALL TIME: {convert_seconds((time.time() - start_time))}\n')
 
-    def expand_candidates_diagnosis_variation(self, prompts: List) -> Tuple[List, List]:
-        """Expand prompts using feedback and random mutators."""
+    def expand_candidates_diagnosis_variation(self, prompts: List, on_candidates: Optional[Callable[[List], None]] = None) -> Tuple[List, List]:
+        """Expand prompts using feedback and random mutators, passing each mutator's new prompts to on_candidates as they come."""
         temperature = self.get_temperature()
         num_component = self.get_num_mutations()
 
         self.logger.info(f"\n--------- Curr Round: {self.round}, Curr prompts length: {len(prompts)} to expand, Curr temperature: {temperature}, Curr Mutate Component number: {num_component}\n")
 
         minibatch = self.task.sample_minibatch()
-        new_prompts = []
 
-        for i, prompt in enumerate(prompts):
-            self.logger.info(f"\n-------- In Round {self.round}. Start to expand {i} prompt through feedback and random mutators --------\n")
-            new_prompts_per_prompt = [prompt]
-            if self.num_prompts_per_round['case_diagnosis'] > 0:
-                new_prompts_per_prompt += self.case_diagnosis(prompt, minibatch, self.num_prompts_per_round['case_diagnosis'], num_component, self.round, temperature)
-            if self.num_prompts_per_round['monte_carlo_sampling'] > 0:
-                new_prompts_per_prompt += self.monte_carlo_sampling(prompt, self.num_prompts_per_round['monte_carlo_sampling'], num_component, self.round, temperature)
-            new_prompts.append(new_prompts_per_prompt)
+        # Seeds are drawn up front, so each beam member's expansion is reproducible whichever worker runs it
+        seeds = [random.getrandbits(32) for _ in prompts]
+        expand = bind_context(self._expand_prompt_diagnosis_variation)
+        with ThreadPoolExecutor(max_workers=max(1, min(len(prompts), self.expand_workers)), thread_name_prefix='expand') as executor:
+            new_prompts = list(executor.map(
+                lambda i: expand(i, prompts[i], minibatch, num_component, temperature, seeds[i], on_candidates),
+                range(len(prompts)),
+            ))
 
         return new_prompts, minibatch
 
+    def _expand_prompt_diagnosis_variation(self, i: int, prompt, minibatch: List, num_component: int, temperature: float, seed: int, on_candidates: Optional[Callable[[List], None]] = None) -> List:
+        """Expand one beam member through the feedback and random mutators. Returns the prompt followed by its children."""
+        new_prompts_per_prompt = [prompt]
+        if self._opt_budget_exhausted():
+            self.logger.info(f"\n-------- In Round {self.round}. Optimizer LLM token budget exhausted, {i} prompt is not expanded --------\n")
+            return new_prompts_per_prompt
+
+        self.logger.info(f"\n-------- In Round {self.round}. Start to expand {i} prompt through feedback and random mutators --------\n")
+        with seeded_rng(seed):
+            if self.num_prompts_per_round['case_diagnosis'] > 0:
+                with usage_context(mutator='case_diagnosis'):
+                    children = self.case_diagnosis(prompt, minibatch, self.num_prompts_per_round['case_diagnosis'], num_component, self.round, temperature)
+                if on_candidates:
+                    on_candidates(children)
+                new_prompts_per_prompt += children
+            if self.num_prompts_per_round['monte_carlo_sampling'] > 0:
+                with usage_context(mutator='monte_carlo_sampling'):
+                    children = self.monte_carlo_sampling(prompt, self.num_prompts_per_round['monte_carlo_sampling'], num_component, self.round, temperature)
+                if on_candidates:
+                    on_candidates(children)
+                new_prompts_per_prompt += children
+        return new_prompts_per_prompt
+
     def expand_candidates_format(self, prompts: List) -> List:
         """Expand prompts using the format mutator."""
-        if self.num_prompts_per_round['format'] > 0:
+        if self.num_prompts_per_round['format'] > 0 and not self._opt_budget_exhausted():
             self.logger.info(f"\n--------- Curr Round: {self.round}, Curr prompts length: {len(prompts)} to expand\n")
-            return self.format_mutator(prompts, self.num_prompts_per_round['format'], self.round)
+            with usage_context(mutator='format'):
+                return self.format_mutator(prompts, self.num_prompts_per_round['format'], self.round)
         return [[prompt] for prompt in prompts]
 
     def score_candidates(self, prompts: List) -> Tuple[List, List]:
         """Score a list of prompts."""
         prompts = [item for sublist in prompts for item in sublist]  # Flatten list
-        scores = []
+        prompts = self._deduplicate(prompts)
+
+        unscored = [prompt for prompt in prompts if prompt.eval_score is None]
+        eliminated = set()
+        if self.screen_ratio < 1 and unscored:
+            with usage_context(phase='screen'):
+                screened_out = self._screen_candidates(unscored)
+            eliminated |= screened_out
+            unscored = [prompt for prompt in unscored if id(prompt) not in screened_out]
+
+        if self.score_method == 'full':
+            self._score_full(unscored)
+        elif self.score_method == 'racing':
+            eliminated |= self._score_racing([prompt for prompt in prompts if id(prompt) not in eliminated])
+        else:
+            raise ValueError(f"Unknown score method: {self.score_method}")
 
-        for prompt in prompts:
-            if prompt.eval_score is None:
-                score, _, _, _, _ = self.task.run_evaluate(self.eval_llm, prompt, self.task.valid_set, desc='Run evaluate on valid set')
-                prompt.eval_score = score
-                prompt.improved_score = score - prompt.parent.eval_score if prompt.parent else None
-            else:
-                score = prompt.eval_score
-            scores.append(score)
+        self._set_improved_scores(unscored)
 
-        combined = list(zip(prompts, scores))
+        if self.screen_ratio < 1:
+            self._log_screen_agreement(unscored)
+
+        # Candidates eliminated by screening or racing were not fully scored and never enter the beam
+        candidates = [prompt for prompt in prompts if id(prompt) not in eliminated]
+        scores = [prompt.eval_score for prompt in candidates]
+
+        combined = list(zip(candidates, scores))
         sorted_combined = sorted(combined, key=lambda x: x[1], reverse=True)[:self.beam_size]
         sorted_prompts, sorted_scores = zip(*sorted_combined)
 
         self.logger.info(f"Round {self.round} Number of selected prompts: {len(sorted_prompts)}")
+        low, high = self.valid_scores.bootstrap_ci(sorted_prompts[0].content_hash())
+        self.logger.info(f"Round {self.round} Best valid score: {sorted_scores[0]} (95% bootstrap CI [{low:.4f}, {high:.4f}])")
         return list(sorted_prompts), list(sorted_scores)
 
+    def _deduplicate(self, prompts: List) -> List:
+        """
+        Drop candidates rendering to the same prompt as another candidate of the round, keeping already scored
+        ones, and reuse the scores of candidates rendering to a prompt scored in an earlier round.
+        """
+        first = {}
+        for prompt in sorted(prompts, key=lambda prompt: prompt.eval_score is None):
+            first.setdefault(prompt.content_hash(), prompt)
+        kept = {id(prompt) for prompt in first.values()}
+        unique = [prompt for prompt in prompts if id(prompt) in kept]
+
+        num_reused = self._reuse_scores(unique)
+        if len(unique) < len(prompts) or num_reused:
+            self.logger.info(f"Round {self.round} Deduplication: {len(prompts) - len(unique)} duplicate candidates dropped, {num_reused} scores reused")
+        return unique
+
+    def _reuse_scores(self, prompts: List) -> int:
+        """Give the unscored prompts that render to an already scored prompt its scores. Returns the number of such prompts."""
+        num_reused = 0
+        for prompt in prompts:
+            scored = self.scored_prompts.get(prompt.content_hash())
+            if prompt.eval_score is None and scored is not None:
+                prompt.eval_score = scored.eval_score
+                prompt.screen_score = scored.screen_score
+                num_reused += 1
+        return num_reused
+
+    def _set_improved_scores(self, prompts: List):
+        for prompt in prompts:
+            prompt.improved_score = prompt.eval_score - prompt.parent.eval_score if prompt.parent else None
+
+    def _score_pipelined(self, prompts: List):
+        """Score a batch of candidates queued by the expansion, on the pipeline's consumer thread."""
+        with usage_context(phase='score'):
+            self._score_full(prompts)
+        self._set_improved_scores(prompts)
+
+    def _screen_candidates(self, prompts: List) -> set:
+        """
+        Rank prompts with the screening model on the screening slice, and keep the top screen_ratio
+        fraction for full scoring. Returns the ids of the prompts that are not promoted.
+        """
+        screen_llm = self.screen_llm or self.eval_llm
+        examples = self.task.valid_set if self.screen_size == -1 else self.task.valid_set[:self.screen_size]
+        results = self.task.run_evaluate_batch(screen_llm, prompts, examples, desc='Run screening on valid set')
+        for prompt, (score, _, _, _, score_list) in zip(prompts, results):
+            prompt.screen_score = score
+            # Screening with the eval model itself yields full-fidelity outcomes on the slice
+            if self.screen_llm is None:
+                key = prompt.content_hash()
+                self.valid_scores.record(key, np.arange(len(score_list)), score_list)
+                # On the whole valid set these are the full scores, which are not evaluated again
+                if len(examples) == len(self.task.valid_set):
+                    prompt.eval_score = score
+                    self.scored_prompts.setdefault(key, prompt)
+
+        num_promoted = max(1, math.ceil(self.screen_ratio * len(prompts)))
+        ranked = sorted(prompts, key=lambda prompt: prompt.screen_score, reverse=True)
+        self.logger.info(f"Round {self.round} Screening: {num_promoted} of {len(prompts)} candidates promoted to full scoring")
+        return {id(prompt) for prompt in ranked[num_promoted:]}
+
+    def _log_screen_agreement(self, prompts: List):
+        """Log how often screening and full scores order pairs of promoted candidates differently."""
+        screen_scores = np.array([prompt.screen_score for prompt in prompts], dtype=float)
+        full_scores = np.array([prompt.eval_score for prompt in prompts], dtype=float)
+        screen_order = np.sign(screen_scores[:, None] - screen_scores[None, :])
+        full_order = np.sign(full_scores[:, None] - full_scores[None, :])
+
+        upper = np.triu_indices(len(prompts), k=1)
+        self.screen_pairs += len(upper[0])
+        self.screen_discordant_pairs += int((screen_order[upper] * full_order[upper] < 0).sum())
+        rate = self.screen_discordant_pairs / self.screen_pairs if self.screen_pairs else 0
+        self.logger.info(f"Round {self.round} Screening disagreement: {self.screen_discordant_pairs} of {self.screen_pairs} candidate pairs ordered differently ({rate:.2%})")
+
+    def _score_full(self, prompts: List):
+        """Score every prompt on the whole valid set in a single batched pass, evaluating each distinct prompt once."""
+        self._reuse_scores(prompts)
+        duplicates = {}
+        for prompt in prompts:
+            if prompt.eval_score is None:
+                duplicates.setdefault(prompt.content_hash(), []).append(prompt)
+        if not duplicates:
+            return
+
+        to_evaluate = [group[0] for group in duplicates.values()]
+        results = self.task.run_evaluate_batch(self.eval_llm, to_evaluate, self.task.valid_set, desc='Run evaluate on valid set')
+        for prompt, (score, _, _, _, score_list) in zip(to_evaluate, results):
+            key = prompt.content_hash()
+            self.valid_scores.record(key, np.arange(len(score_list)), score_list)
+            self.scored_prompts.setdefault(key, prompt)
+            for duplicate in duplicates[key]:
+                duplicate.eval_score = score
+
+    def _score_racing(self, prompts: List) -> set:
+        """
+        Score prompts by racing on shared slices of the valid set.
+
+        All surviving candidates are evaluated on the same slice, then the ones whose paired
+        per-example difference to the beam_size-th best candidate is significantly negative
+        are dropped. Outcomes already in the score matrix are reused instead of re-evaluated.
+        Returns the ids of the eliminated prompts.
+        """
+        num_valid = len(self.task.valid_set)
+        keys = {id(prompt): prompt.content_hash() for prompt in prompts}
+        survivors = list(prompts)
+
+        for start in range(0, num_valid, self.race_slice_size):
+            end = min(start + self.race_slice_size, num_valid)
+            example_ids = np.arange(start, end)
+            to_evaluate = [prompt for prompt in survivors if not self.valid_scores.is_evaluated(keys[id(prompt)], example_ids)]
+            if to_evaluate:
+                results = self.task.run_evaluate_batch(self.eval_llm, to_evaluate, self.task.valid_set[start:end], desc=f'Run evaluate on valid set [{start}:{end}]')
+                for prompt, (_, _, _, _, score_list) in zip(to_evaluate, results):
+                    self.valid_scores.record(keys[id(prompt)], example_ids, score_list)
+
+            if end < num_valid:
+                survivors = self._race_survivors(survivors, keys, end)
+                self.logger.info(f"Round {self.round} Racing on [0:{end}]: {len(survivors)} candidates survive")
+
+        for prompt in prompts:
+            if prompt.eval_score is None:
+                prompt.eval_score = self.valid_scores.mean(keys[id(prompt)])
+        # Eliminated candidates are only scored on a prefix of the valid set
+        for prompt in survivors:
+            self.scored_prompts.setdefault(keys[id(prompt)], prompt)
+
+        return {id(prompt) for prompt in prompts} - {id(prompt) for prompt in survivors}
+
+    def _race_survivors(self, prompts: List, keys: Dict, n: int) -> List:
+        """Keep the prompts not dominated by the beam_size-th best prompt on the first n examples."""
+        if len(prompts) <= self.beam_size:
+            return prompts
+
+        outcomes = self.valid_scores.get([keys[id(prompt)] for prompt in prompts], np.arange(n))
+        means = outcomes.mean(axis=1)
+        reference = np.argsort(-means, kind='stable')[self.beam_size - 1]
+
+        diffs = outcomes - outcomes[reference]
+        std_err = diffs.std(axis=1, ddof=1) / np.sqrt(n) if n > 1 else np.zeros(len(prompts))
+        keep = diffs.mean(axis=1) + self.race_z * std_err >= 0
+        return [prompt for prompt, kept in zip(prompts, keep) if kept]
+
+    def _progress(self) -> float:
+        """Fraction of the run done: of the budget when it is scheduled, of the rounds otherwise."""
+        if self.scheduler and self.round_plan:
+            return self.round_plan.progress
+        return self.round / self.total_round
+
     def get_temperature(self) -> float:
         """Get the current temperature based on the scheduler."""
         if self.opt_controller.temp_scheduler == 'linear_temp_0.7':
-            return self.init_temperature - (self.round / self.total_round) * (self.init_temperature - 0.7)
+            return self.init_temperature - self._progress() * (self.init_temperature - 0.7)
         elif self.opt_controller.temp_scheduler == 'linear_temp_0.5':
-            return self.init_temperature - (self.round / self.total_round) * (self.init_temperature - 0.5)
+            return self.init_temperature - self._progress() * (self.init_temperature - 0.5)
         elif self.opt_controller.temp_scheduler == 'exp_temp':
-            return self.init_temperature * (0.1 / self.init_temperature) ** (self.round / self.total_round)
+            return self.init_temperature * (0.1 / self.init_temperature) ** self._progress()
         elif self.opt_controller.temp_scheduler == 'linear_temp':
-            return self.init_temperature - (self.round / self.total_round) * (self.init_temperature - 0.1)
+            return self.init_temperature - self._progress() * (self.init_temperature - 0.1)
         return self.init_temperature
 
     def get_num_mutations(self) -> int:
@@ -269,7 +697,9 @@ class Optimizer:
             "multimute_5": [1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
         }.get(self.opt_controller.mutate_scheduler, [1] * (self.total_round + 1))
 
-        if len(steps_list) - 1 < self.total_round:
-            steps_list.extend([steps_list[-1]] * (self.total_round + 1 - len(steps_list)))
+        # Scheduled runs are not bounded by total_round
+        last_round = max(self.total_round, self.round)
+        if len(steps_list) - 1 < last_round:
+            steps_list.extend([steps_list[-1]] * (last_round + 1 - len(steps_list)))
 
         return steps_list[self.round // 2]
\ No newline at end of file
@@ -2,9 +2,49 @@
 # Licensed under the MIT license.
 
 import os
+import re
 import pickle
+import hashlib
+from liquid import Template
+from checkpoint import atomic_pickle
+from mutators import generated_formats
 from typing import List, Dict, Any, Optional, Callable, Tuple
 
+class RenderPlan:
+    """
+    Compiled form of a rendered prompt: the Liquid template is parsed once and the static text
+    around the {{query}} slot is kept, so that evaluating an example only fills in the query.
+    """
+
+    QUERY_SENTINEL = "\x00CFPO_QUERY\x00"
+
+    def __init__(self, text: str):
+        self.template = Template(text)
+        rendered = self.template.render(query=self.QUERY_SENTINEL)
+
+        # Fall back to rendering the parsed template if the query slot is not filled verbatim exactly once
+        if rendered.count(self.QUERY_SENTINEL) == 1:
+            self.prefix, self.suffix = rendered.split(self.QUERY_SENTINEL)
+        else:
+            self.prefix, self.suffix = None, None
+
+    def render(self, query: str) -> str:
+        """
+        Renders the prompt for one query.
+
+        Args:
+            query (str): The rendered query to fill into the prompt.
+
+        Returns:
+            str: The rendered prompt, with runs of blank lines collapsed.
+        """
+        if self.prefix is not None:
+            text = self.prefix + query + self.suffix
+        else:
+            text = self.template.render(query=query)
+        return re.sub(r'\n{3,}', '\n\n', text) if '\n\n\n' in text else text
+
+
 class Prompt:
     """
     Represents a prompt in a hierarchical structure, allowing for the generation of child prompts
@@ -50,6 +90,7 @@ class Prompt:
         self.parent = None
         self.children = []
         self.eval_score = None
+        self.screen_score = None
         self.test_score = None
         self.improved_score = None
         self.round = round
@@ -65,6 +106,7 @@ class Prompt:
         self.action_detail = action_detail
         self.task = task
         self.cot_hinter = kwargs.get('cot_hinter', 'Let\'s think step by step.') if task in ['GSM8K', 'MATH'] else None
+        self._render_plan = None
     
     def render_examples(self, examples: List[Dict[str, Any]]) -> str:
         """
@@ -143,6 +185,49 @@ class Prompt:
     def __str__(self) -> str:
         return self.render_all()
 
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state['_render_plan'] = None
+        return state
+
+    def canonical_text(self) -> str:
+        """
+        Renders the prompt, followed by a placeholder query rendered with the query format, with whitespace
+        normalized: runs of spaces within lines become one space, trailing whitespace and repeated blank lines
+        are removed, and indentation is kept. The sample query tells apart prompts that differ only in the
+        query format, which the rendered prompt alone shows through its examples only.
+
+        Returns:
+            str: The canonical rendering of the prompt.
+        """
+        sample_query = self.render_query('{{question}}', choices=[f'{{{{choice_{letter}}}}}' for letter in 'abcd'])
+        text = re.sub(r'(?<=\S)[ \t]+', ' ', f"{self}\n\n{sample_query}")
+        text = re.sub(r'[ \t]+\n', '\n', text)
+        return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+    def content_hash(self) -> str:
+        """
+        Hashes the canonical rendering of the prompt, so that prompts differing only in whitespace share a hash.
+
+        Returns:
+            str: SHA-256 hex digest of the canonical rendering.
+        """
+        return hashlib.sha256(self.canonical_text().encode('utf-8')).hexdigest()
+
+    def get_render_plan(self) -> RenderPlan:
+        """
+        Returns the compiled render plan of the prompt, rebuilding it when the content has changed.
+
+        Returns:
+            RenderPlan: The render plan keyed by the current content hash.
+        """
+        text = str(self)
+        key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        cached = getattr(self, '_render_plan', None)
+        if cached is None or cached[0] != key:
+            self._render_plan = (key, RenderPlan(text))
+        return self._render_plan[1]
+
     def generate(
         self,
         round: int,
@@ -213,15 +298,23 @@ class PromptHistory:
         self.format_pool = {}
         self.beam_history = {}
 
+    def __getstate__(self) -> Dict[str, Any]:
+        # The generated formats come first, so that they are registered again before the prompts using them are loaded
+        return {'generated_formats': generated_formats.snapshot(), **self.__dict__}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        state.pop('generated_formats', None)
+        self.__dict__.update(state)
+
     def save(self, path: str) -> None:
         output_path = os.path.join(self.root_path, path)
         os.makedirs(output_path, exist_ok=True)
-        output_path = os.path.join(output_path, f"{self.round}.pkl")
-        pickle.dump(self, open(output_path, "wb"))
+        atomic_pickle(self, os.path.join(output_path, f"{self.round}.pkl"))
+
     @classmethod
-    def load(cls, project_name: str, round: int) -> 'PromptHistory':
-        path = os.path.join(self.root_path, project_name, f"{round}.pkl")
-        return pickle.load(open(path, "rb"))
+    def load(cls, root_path: str, path: str, round: int) -> 'PromptHistory':
+        with open(os.path.join(root_path, path, f"{round}.pkl"), "rb") as f:
+            return pickle.load(f)
 
     def add_root(self, prompt: Prompt) -> None:
         if self.root is None:
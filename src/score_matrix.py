@@ -0,0 +1,127 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import os
+import threading
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple
+
+class ScoreMatrix:
+    """
+    Run-wide matrix of per-example outcomes, indexed by (prompt id, example id).
+
+    Rows are prompts (identified by their content hash), columns are the examples of one
+    split. Entries that have not been evaluated are NaN.
+    """
+
+    def __init__(self, num_examples: int, capacity: int = 64):
+        """
+        Initializes an empty score matrix.
+
+        Args:
+            num_examples (int): Number of examples in the split.
+            capacity (int, optional): Initial number of rows. Defaults to 64.
+        """
+        self.num_examples = num_examples
+        self.prompt_index: Dict[str, int] = {}
+        self.data = np.full((capacity, num_examples), np.nan, dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict:
+        # Consistent while the test-set worker records outcomes, e.g. when a run is checkpointed
+        with self._lock:
+            state = self.__dict__.copy()
+            state['prompt_index'] = dict(self.prompt_index)
+            state['data'] = self.data.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _row(self, key: str) -> int:
+        if key not in self.prompt_index:
+            if len(self.prompt_index) == self.data.shape[0]:
+                grown = np.full((2 * self.data.shape[0], self.num_examples), np.nan, dtype=np.float32)
+                grown[:self.data.shape[0]] = self.data
+                self.data = grown
+            self.prompt_index[key] = len(self.prompt_index)
+        return self.prompt_index[key]
+
+    def record(self, key: str, example_ids: Sequence[int], scores: Sequence[float]) -> None:
+        """Record the outcomes of a prompt on the given examples."""
+        with self._lock:
+            # The row is looked up first, as adding it may grow (replace) the data array
+            row = self._row(key)
+            self.data[row, np.asarray(example_ids, dtype=np.int64)] = scores
+
+    def get(self, keys: List[str], example_ids: Optional[Sequence[int]] = None) -> np.ndarray:
+        """Return the (len(keys), len(example_ids)) block of outcomes, NaN where unknown."""
+        columns = slice(None) if example_ids is None else np.asarray(example_ids, dtype=np.int64)
+        with self._lock:
+            block = np.full((len(keys), self.num_examples), np.nan, dtype=np.float32)
+            known = [(i, self.prompt_index[key]) for i, key in enumerate(keys) if key in self.prompt_index]
+            if known:
+                block[[i for i, _ in known]] = self.data[[row for _, row in known]]
+        return block[:, columns]
+
+    def is_evaluated(self, key: str, example_ids: Sequence[int]) -> bool:
+        return bool(np.all(~np.isnan(self.get([key], example_ids))))
+
+    def mean(self, key: str, example_ids: Optional[Sequence[int]] = None) -> float:
+        """Mean outcome of a prompt over its evaluated examples."""
+        row = self.get([key], example_ids)[0]
+        return float(np.nanmean(row)) if np.any(~np.isnan(row)) else 0.0
+
+    def paired_difference(self, key_a: str, key_b: str) -> np.ndarray:
+        """Per-example differences a - b on the examples evaluated for both prompts."""
+        block = self.get([key_a, key_b])
+        both = ~np.isnan(block).any(axis=0)
+        return block[0, both] - block[1, both]
+
+    def bootstrap_ci(self, key: str, num_samples: int = 1000, alpha: float = 0.05, seed: int = 0) -> Tuple[float, float]:
+        """Percentile bootstrap confidence interval of a prompt's mean outcome."""
+        row = self.get([key])[0]
+        return self._bootstrap(row[~np.isnan(row)], num_samples, alpha, seed)
+
+    def paired_bootstrap_ci(self, key_a: str, key_b: str, num_samples: int = 1000, alpha: float = 0.05, seed: int = 0) -> Tuple[float, float]:
+        """Percentile bootstrap confidence interval of the mean paired difference a - b."""
+        return self._bootstrap(self.paired_difference(key_a, key_b), num_samples, alpha, seed)
+
+    @staticmethod
+    def _bootstrap(values: np.ndarray, num_samples: int, alpha: float, seed: int) -> Tuple[float, float]:
+        if values.size == 0:
+            return (float('nan'), float('nan'))
+        rng = np.random.default_rng(seed)
+        means = values[rng.integers(0, values.size, size=(num_samples, values.size))].mean(axis=1)
+        return (float(np.quantile(means, alpha / 2)), float(np.quantile(means, 1 - alpha / 2)))
+
+    def example_difficulty(self, keys: Optional[List[str]] = None) -> np.ndarray:
+        """Per-example failure rate over the given prompts (all prompts if None), NaN if never evaluated."""
+        block = self.get(keys if keys is not None else list(self.prompt_index))
+        evaluated = ~np.isnan(block)
+        counts = evaluated.sum(axis=0)
+        solved = np.where(evaluated, block, 0).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, 1 - solved / np.maximum(counts, 1), np.nan)
+
+    def save(self, path: str) -> None:
+        """Save the matrix to a .npz file."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._lock:
+            keys = sorted(self.prompt_index, key=self.prompt_index.get)
+            data = self.data[:len(keys)]
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(tmp_path, keys=np.array(keys, dtype=str), data=data)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ScoreMatrix':
+        """Load a matrix saved with save()."""
+        archive = np.load(path)
+        keys, data = list(archive['keys']), archive['data']
+        matrix = cls(data.shape[1], capacity=max(len(keys), 64))
+        matrix.data[:len(keys)] = data
+        matrix.prompt_index = {str(key): i for i, key in enumerate(keys)}
+        return matrix
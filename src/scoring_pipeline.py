@@ -0,0 +1,63 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import queue
+import threading
+from usage import bind_context
+from typing import Callable, List, Optional
+
+_DONE = object()
+
+class ScoringPipeline:
+    """
+    Consumer side of a pipelined round: candidates are submitted as soon as a mutator returns them,
+    and a background thread scores them in batches of whatever has queued up while the previous
+    batch was on the GPU, so that scoring overlaps the expansion still in flight.
+    """
+
+    def __init__(self, score_fn: Callable[[List], None]):
+        """
+        Start the consumer thread.
+
+        Args:
+            score_fn (Callable[[List], None]): Scores a batch of prompts in place. Runs in the caller's context.
+        """
+        self.score_fn = score_fn
+        self.num_batches = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=bind_context(self._run), name='score-pipeline', daemon=True)
+        self._thread.start()
+
+    def submit(self, prompts: List) -> None:
+        """Queue prompts for scoring; prompts that already have a score are skipped."""
+        for prompt in prompts:
+            self._queue.put(prompt)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            done = any(prompt is _DONE for prompt in batch)
+            batch = [prompt for prompt in batch if prompt is not _DONE and prompt.eval_score is None]
+            # After a failure the remaining candidates are drained unscored, and close() re-raises
+            if batch and self._error is None:
+                try:
+                    self.score_fn(batch)
+                    self.num_batches += 1
+                except BaseException as e:
+                    self._error = e
+            if done:
+                return
+
+    def close(self) -> None:
+        """Wait until every submitted prompt is scored, re-raising the first scoring error."""
+        self._queue.put(_DONE)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
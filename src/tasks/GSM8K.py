@@ -1,12 +1,11 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
-from .base import BaseTask
+from .base import BaseTask, StoppingPolicy
 import datasets
 import random
 import re
 from tqdm import tqdm
-from liquid import Template
 from typing import List, Dict, Tuple, Optional
 import logging
 
@@ -39,6 +38,9 @@ class GSM8KTask(BaseTask):
         train_examples = self._pre_process(dataset["train"])
         test_examples = self._pre_process(dataset['test'])
 
+        # The decode budget is learned from the whole train split, not only the few train_size examples
+        self.reference_answers = [ex['answer'] for ex in train_examples]
+
         # Split dataset into train, validation, and test sets
         test_set = test_examples if self.test_size == -1 else test_examples[:self.test_size]
 
@@ -128,38 +130,44 @@ class GSM8KTask(BaseTask):
         except ValueError:
             return False
 
-    def run_evaluate(
+    def get_stopping_policy(self, tokenizer=None) -> StoppingPolicy:
+        """
+        Stop decoding once an answer is complete: the budget is learned from the answers of the train split,
+        and a completion is truncated after the first sentence following the answer marker that ends with a number.
+        """
+        answer_pattern = re.escape(self.answer_marker.strip()) + r"[^\n]*?\d\.(?=\s|$)"
+        return StoppingPolicy(
+            max_tokens=self._learn_max_tokens(self.reference_answers, tokenizer),
+            answer_pattern=answer_pattern,
+        )
+
+    def render_eval_query(self, prompt, example: Dict) -> Optional[str]:
+        """
+        Render the query of one example in the query format of the prompt.
+        """
+        return prompt.render_query(question=example['question'])
+
+    def check_example(self, example: Dict, pred: str) -> int:
+        """
+        Score one prediction against its example.
+        """
+        return int(self.check_answer(pred, example['answer']))
+
+    def score_predictions(
         self,
-        eval_llm,
-        prompt,
         examples: List[Dict],
+        preds: List[str],
         desc: Optional[str] = None,
+        score_list: Optional[List[int]] = None,
     ) -> Tuple[float, List[str], List[str], List[str], List[int]]:
         """
-        Evaluate the model on the given examples.
+        Score the model predictions on the given examples, unless already scored.
         """
-        questions, answers, score_list, prompts = [], [], [], []
-
-        for example in examples:
-            query_text = prompt.render_query(question=example['question'])
-            if not query_text:
-                continue
-
-            try:
-                temp_prompt = Template(str(prompt)).render(query=query_text)
-                temp_prompt = re.sub(r'\n{3,}', '\n\n', temp_prompt)
-                prompts.append(temp_prompt)
-            except Exception as e:
-                self.logger.error(f"Error rendering prompt: {e}")
-                continue
-
-        preds = eval_llm.inference(prompts, use_batch_acceleration=True, desc=desc)
+        questions = [ex['question'] for ex in examples]
+        answers = [ex['answer'] for ex in examples]
 
-        for ex, pred in tqdm(zip(examples, preds), desc=desc, leave=True):
-            questions.append(ex['question'])
-            answers.append(ex['answer'])
-            score = int(self.check_answer(pred, ex['answer']))
-            score_list.append(score)
+        if score_list is None:
+            score_list = [self.check_example(ex, pred) for ex, pred in tqdm(zip(examples, preds), desc=desc, leave=True)]
 
         score = sum(score_list) / len(score_list) if score_list else 0
-        return score, questions, answers, preds, score_list
\ No newline at end of file
+        return score, questions, answers, preds, score_list
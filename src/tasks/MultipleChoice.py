@@ -5,8 +5,7 @@ import datasets
 import re
 from tqdm import tqdm
 from typing import List, Dict, Tuple, Optional
-from .base import BaseTask
-from liquid import Template
+from .base import BaseTask, StoppingPolicy
 import logging
 import random
 
@@ -68,9 +67,11 @@ class MultipleChoiceTask(BaseTask):
         random.shuffle(out_doc)
         return out_doc
 
-    def extract_answer(self, response: str) -> str:
+    def extract_answer(self, response: str) -> Optional[str]:
         """Extract the answer from the model's response."""
         response = response.strip().upper()
+        if not response:
+            return None
         if response[0] in self.letter_to_num:
             return response[0]
         if response in self.num_to_letter:
@@ -82,31 +83,30 @@ class MultipleChoiceTask(BaseTask):
         pred_answer = self.extract_answer(pred)
         return pred_answer in answer if pred_answer else False
 
-    def run_evaluate(
-        self, eval_llm, prompt, examples: List[Dict], desc: Optional[str] = None
-    ) -> Tuple[float, List[Tuple[str, List[str]]], List[str], List[str], List[int]]:
-        """Evaluate the model on the given examples."""
-        texts, answers, score_list, prompts = [], [], [], []
+    def get_stopping_policy(self, tokenizer=None) -> StoppingPolicy:
+        """Stop decoding after the answer label: only the first letter of a response is used."""
+        return StoppingPolicy(
+            max_tokens=self._learn_max_tokens([ex["label"][0] for ex in self.train_set], tokenizer),
+            answer_pattern=r"^\s*\(?[A-E]\b",
+        )
 
-        for example in examples:
-            query_text = prompt.render_query(question=example["question"], choices=example["choices"])
-            if not query_text:
-                continue
+    def render_eval_query(self, prompt, example: Dict) -> Optional[str]:
+        """Render the query of one example in the query format of the prompt."""
+        return prompt.render_query(question=example["question"], choices=example["choices"])
 
-            try:
-                rendered_prompt = Template(str(prompt)).render(query=query_text)
-                rendered_prompt = re.sub(r"\n{3,}", "\n\n", rendered_prompt)
-                prompts.append(rendered_prompt)
-            except Exception as e:
-                self.logger.error(f"Error rendering prompt: {e}")
-                continue
+    def check_example(self, example: Dict, pred: str) -> int:
+        """Score one prediction against its example."""
+        return int(self.check_answer(pred, example["label"]))
 
-        preds = eval_llm.inference(prompts, use_batch_acceleration=True, desc=desc)
+    def score_predictions(
+        self, examples: List[Dict], preds: List[str], desc: Optional[str] = None, score_list: Optional[List[int]] = None
+    ) -> Tuple[float, List[Tuple[str, List[str]]], List[str], List[str], List[int]]:
+        """Score the model predictions on the given examples, unless already scored."""
+        texts = [(ex["question"], ex["choices"]) for ex in examples]
+        answers = [ex["label"][0] for ex in examples]
 
-        for ex, pred in tqdm(zip(examples, preds), desc=desc, leave=True):
-            texts.append((ex["question"], ex["choices"]))
-            answers.append(ex["label"][0])
-            score_list.append(int(self.check_answer(pred, ex["label"])))
+        if score_list is None:
+            score_list = [self.check_example(ex, pred) for ex, pred in tqdm(zip(examples, preds), desc=desc, leave=True)]
 
         score = sum(score_list) / len(score_list) if score_list else 0
-        return score, texts, answers, preds, score_list
\ No newline at end of file
+        return score, texts, answers, preds, score_list
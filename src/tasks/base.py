@@ -1,11 +1,34 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import re
+import math
 import random
 import logging
 from typing import List, Dict, Tuple, Optional
 
 
+class StoppingPolicy:
+    """
+    Task-provided decoding limits for the eval LLM: extra stop strings, a max_tokens budget,
+    and a pattern marking the end of a complete answer, after which a completion is truncated.
+    """
+
+    def __init__(self, stop: Optional[List[str]] = None, max_tokens: Optional[int] = None, answer_pattern: Optional[str] = None):
+        self.stop = stop or []
+        self.max_tokens = max_tokens
+        self.answer_pattern = re.compile(answer_pattern) if answer_pattern else None
+
+    def truncate(self, completion: str) -> str:
+        """
+        Cut a runaway completion right after its first complete answer.
+        """
+        if not completion or self.answer_pattern is None:
+            return completion
+        match = self.answer_pattern.search(completion)
+        return completion[:match.end()] if match else completion
+
+
 class BaseTask:
     def __init__(
         self,
@@ -59,6 +82,13 @@ class BaseTask:
         """
         raise NotImplementedError("Subclasses must implement this method.")
 
+    def set_dataset(self, dataset: Tuple[List[Dict], List[Dict], List[Dict]]) -> None:
+        """
+        Replace the train, validation and test sets, e.g. with the split of a checkpointed run.
+        """
+        self.dataset = dataset
+        self.train_set, self.valid_set, self.test_set = dataset
+
     def sample_minibatch(self) -> List[Dict]:
         """
         Sample a minibatch from the training set.
@@ -76,4 +106,111 @@ class BaseTask:
         """
         Check if the response matches the ground truth.
         """
-        raise NotImplementedError("Subclasses must implement this method.")
\ No newline at end of file
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    def get_stopping_policy(self, tokenizer=None) -> StoppingPolicy:
+        """
+        Get the decoding limits for evaluating this task.
+        """
+        return StoppingPolicy()
+
+    def _learn_max_tokens(self, texts: List[str], tokenizer=None, percentile: float = 0.99, slack: float = 2.0, margin: int = 16) -> Optional[int]:
+        """
+        Learn a max_tokens budget from the token lengths of reference answers: a high percentile of the lengths,
+        with enough slack for eval models that answer more verbosely than the references.
+        """
+        if not texts:
+            return None
+        if tokenizer is not None:
+            lengths = [len(tokenizer.encode(text, add_special_tokens=False)) for text in texts]
+        else:
+            # Rough estimate of about 4 characters per token when no tokenizer is available
+            lengths = [math.ceil(len(text) / 4) for text in texts]
+        lengths.sort()
+        length = lengths[max(0, math.ceil(percentile * len(lengths)) - 1)]
+        max_tokens = math.ceil(length * slack) + margin
+        self.logger.info(f"Learned a max_tokens budget of {max_tokens} from {len(texts)} reference answers (percentile {percentile:.0%}: {length} tokens)")
+        return max_tokens
+
+    def render_eval_query(self, prompt, example: Dict) -> Optional[str]:
+        """
+        Render the query of one example in the query format of the prompt.
+        """
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    def check_example(self, example: Dict, pred: str) -> int:
+        """
+        Score one prediction against its example.
+        """
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    def score_predictions(self, examples: List[Dict], preds: List[str], desc: Optional[str] = None, score_list: Optional[List[int]] = None) -> Tuple[float, List, List, List[str], List[int]]:
+        """
+        Score the predictions of the model against the given examples, unless already scored.
+        """
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    def build_eval_inputs(self, prompt, examples: List[Dict]) -> List[Optional[str]]:
+        """
+        Render the evaluation inputs of a prompt, aligned with the examples (None if rendering fails).
+        """
+        try:
+            render_plan = prompt.get_render_plan()
+        except Exception as e:
+            self.logger.error(f"Error rendering prompt: {e}")
+            return [None] * len(examples)
+
+        inputs = []
+        for example in examples:
+            try:
+                query_text = self.render_eval_query(prompt, example)
+                inputs.append(render_plan.render(query_text) if query_text else None)
+            except Exception as e:
+                self.logger.error(f"Error rendering prompt: {e}")
+                inputs.append(None)
+        return inputs
+
+    def run_evaluate(self, eval_llm, prompt, examples: List[Dict], desc: Optional[str] = None, background: bool = False) -> Tuple[float, List, List, List[str], List[int]]:
+        """
+        Evaluate the model on the given examples.
+        """
+        return self.run_evaluate_batch(eval_llm, [prompt], examples, desc=desc, background=background)[0]
+
+    def run_evaluate_batch(self, eval_llm, prompts: List, examples: List[Dict], desc: Optional[str] = None, background: bool = False) -> List[Tuple[float, List, List, List[str], List[int]]]:
+        """
+        Evaluate several prompts on the same examples with a single inference call.
+
+        The (prompt x example) inputs of all prompts are sent to the model as one stream,
+        and the predictions are split back into one evaluation result per prompt. Results
+        are aligned with the examples; an example that cannot be rendered gets an empty prediction.
+        """
+        all_inputs, spans = [], []
+        for prompt in prompts:
+            inputs = self.build_eval_inputs(prompt, examples)
+            idxs = [i for i, rendered_prompt in enumerate(inputs) if rendered_prompt is not None]
+            spans.append((len(all_inputs), idxs))
+            all_inputs.extend(inputs[i] for i in idxs)
+
+        # Streaming models yield completions as they finish, so answers are checked while others still decode
+        all_scores = None
+        if not all_inputs:
+            all_preds = []
+        elif hasattr(eval_llm, 'stream'):
+            owners = [(example_idx, prompt_idx) for prompt_idx, (_, idxs) in enumerate(spans) for example_idx in idxs]
+            all_preds, all_scores = [None] * len(all_inputs), [None] * len(all_inputs)
+            for flat_idx, pred in eval_llm.stream(all_inputs, desc=desc, background=background):
+                all_preds[flat_idx] = pred
+                all_scores[flat_idx] = self.check_example(examples[owners[flat_idx][0]], pred)
+        else:
+            all_preds = eval_llm.inference(all_inputs, use_batch_acceleration=True, desc=desc, background=background)
+
+        results = []
+        for start, idxs in spans:
+            preds = [''] * len(examples)
+            score_list = [0] * len(examples) if all_scores is not None else None
+            for offset, i in enumerate(idxs):
+                preds[i] = all_preds[start + offset]
+                if score_list is not None:
+                    score_list[i] = all_scores[start + offset]
+            results.append(self.score_predictions(examples, preds, desc=desc, score_list=score_list))
+        return results
@@ -0,0 +1,121 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Token and cost accounting of model calls.
+
+Models report the prompt and completion tokens of every request they send, and each report is
+attributed to the tags (mutator, round, phase) that the caller set with `usage_context`. Tags live
+in a context variable, so they follow a call into nested helpers; thread pools that fan calls out
+run each one under `bind_context` to carry the caller's tags into the worker thread.
+"""
+
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+TAG_KEYS = ('role', 'model', 'mutator', 'round', 'phase')
+
+_usage_tags: contextvars.ContextVar = contextvars.ContextVar('usage_tags', default={})
+
+
+@contextmanager
+def usage_context(**tags):
+    """Attribute the model calls made inside the block to the given tags, on top of the enclosing ones."""
+    token = _usage_tags.set({**_usage_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _usage_tags.reset(token)
+
+
+def current_tags() -> Dict:
+    return dict(_usage_tags.get())
+
+
+def bind_context(fn: Callable) -> Callable:
+    """Wrap fn to run in a copy of the caller's context, for callables handed to a thread pool."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+class UsageTracker:
+    """
+    Run-wide totals of requests, prompt tokens and completion tokens, broken down by
+    (role, model, mutator, round, phase). Role is 'opt' for the optimizer LLM and 'eval' for
+    the eval and screening LLMs.
+    """
+
+    def __init__(self):
+        self._totals: Dict[Tuple, list] = {}
+        self._prices: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def set_price(self, model: str, prompt_per_1k: float, completion_per_1k: float) -> None:
+        """Set the price of a model, in dollars per 1K prompt and completion tokens."""
+        self._prices[model] = (prompt_per_1k, completion_per_1k)
+
+    def record(self, role: str, model: str, prompt_tokens: int, completion_tokens: int, num_requests: int = 1) -> None:
+        """Add the usage of num_requests requests, attributed to the current tags."""
+        tags = _usage_tags.get()
+        key = (role, model, tags.get('mutator'), tags.get('round'), tags.get('phase'))
+        with self._lock:
+            entry = self._totals.setdefault(key, [0, 0, 0])
+            entry[0] += num_requests
+            entry[1] += prompt_tokens
+            entry[2] += completion_tokens
+
+    def state(self) -> Dict[Tuple, list]:
+        """Copy of the recorded usage, saved with run checkpoints."""
+        with self._lock:
+            return {key: list(entry) for key, entry in self._totals.items()}
+
+    def load_state(self, state: Dict[Tuple, list]) -> None:
+        """Replace the recorded usage with the usage of a checkpointed run. Prices are kept."""
+        with self._lock:
+            self._totals = {key: list(entry) for key, entry in state.items()}
+
+    def totals(self, **filters) -> Dict[str, float]:
+        """
+        Sum the usage matching every given tag, e.g. totals(role='opt', round=3).
+
+        Returns:
+            Dict[str, float]: The number of requests, prompt, completion and total tokens, and the cost in dollars.
+        """
+        unknown = set(filters) - set(TAG_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown usage tags: {sorted(unknown)}, expected some of {TAG_KEYS}")
+
+        result = {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0, 'cost': 0.0}
+        with self._lock:
+            items = list(self._totals.items())
+        for key, (requests, prompt_tokens, completion_tokens) in items:
+            tags = dict(zip(TAG_KEYS, key))
+            if any(tags[name] != value for name, value in filters.items()):
+                continue
+            prompt_price, completion_price = self._prices.get(tags['model'], (0.0, 0.0))
+            result['requests'] += requests
+            result['prompt_tokens'] += prompt_tokens
+            result['completion_tokens'] += completion_tokens
+            result['total_tokens'] += prompt_tokens + completion_tokens
+            result['cost'] += (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+        return result
+
+    def breakdown(self, tag: str, **filters) -> Dict[Optional[str], Dict[str, float]]:
+        """Totals matching filters, grouped by the values of one tag, e.g. breakdown('mutator', round=3)."""
+        index = TAG_KEYS.index(tag)
+        with self._lock:
+            values = {key[index] for key in self._totals}
+        # Rounds sort numerically, other values by name, and untagged usage comes last
+        order = lambda value: (value is None, not isinstance(value, int), value if isinstance(value, int) else str(value))
+        return {value: self.totals(**filters, **{tag: value}) for value in sorted(values, key=order)}
+
+
+# Shared by every model of the process, like the tags it attributes usage to
+usage_tracker = UsageTracker()
+
+
+def format_usage(totals: Dict[str, float]) -> str:
+    return (f"{totals['requests']} requests, {totals['prompt_tokens']} prompt + {totals['completion_tokens']} completion "
+            f"= {totals['total_tokens']} tokens, ${totals['cost']:.4f}")
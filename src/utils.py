@@ -2,6 +2,8 @@
 # Licensed under the MIT license.
 
 import re
+import threading
+from contextlib import contextmanager
 from typing import List, Dict, Tuple, Optional
 
 def parse_tagged_text(text: str, start_tag: str, end_tag: str, logger=None) -> List[str]:
@@ -75,6 +77,33 @@ def stringify_value(value):
 def stringify_dict(d):
     return {stringify_key(k): stringify_value(v) for k, v in d.items()}
 
+class PriorityLock:
+    """Mutex that lets foreground acquirers go ahead of waiting background ones."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._locked = False
+        self._foreground_waiting = 0
+
+    @contextmanager
+    def acquire(self, background: bool = False):
+        with self._cond:
+            if not background:
+                self._foreground_waiting += 1
+            try:
+                while self._locked or (background and self._foreground_waiting > 0):
+                    self._cond.wait()
+            finally:
+                if not background:
+                    self._foreground_waiting -= 1
+            self._locked = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._locked = False
+                self._cond.notify_all()
+
 def convert_seconds(seconds):
     hours = seconds // 3600
     minutes = (seconds % 3600) // 60
@@ -91,14 +120,15 @@ import re
 import os
 import random
 import numpy as np
-import torch
 import multiprocessing
 from typing import Tuple
 from statistics import mean
-from torch.utils.data import Dataset
 
 
 def fix_seeds(seed):
+    # torch is only needed by the legacy data loading helpers, so it is not imported at startup
+    import torch
+
     # random
     random.seed(seed)
     # Numpy
@@ -111,6 +141,7 @@ def fix_seeds(seed):
 
 
 def setup_model_parallel() -> Tuple[int, int]:
+    import torch
     from fairscale.nn.model_parallel.initialize import initialize_model_parallel
     
     local_rank = int(os.environ.get("LOCAL_RANK", -1))
@@ -328,7 +359,7 @@ def data_reader(args):
     return questions, answers
 
 # Create dataset object before dataloader ...
-class MyDataset(Dataset):
+class MyDataset:
     def __init__(self, args):
         super().__init__()
         self.questions, self.answers = data_reader(args)
@@ -343,6 +374,8 @@ class MyDataset(Dataset):
         return input, output
 
 def setup_data_loader(args):
+    import torch
+
     # fix randomness of dataloader to ensure reproducibility
     # https://pytorch.org/docs/stable/notes/randomness.html
     fix_seeds(args.seed)